@@ -0,0 +1,179 @@
+import os
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from PIL import Image
+from . import metrics
+from .storage import SQLiteStore
+
+# Result caching for the classifier. Whole uploads are looked up by an exact content hash, and
+# individual crops by a perceptual hash so that a re-captured object that looks the same reuses
+# its Gemini category.
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2048"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "600"))
+# Optional SQLite file shared by all workers on the machine. Leave unset for in-process only.
+CACHE_PATH = os.getenv("CACHE_PATH")
+
+
+def exact_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> str:
+    """
+    Returns an aHash + dHash fingerprint of the image as a hex string.
+
+    Both hashes are computed on a tiny grayscale thumbnail, so small changes in compression,
+    exposure noise or a pixel or two of framing usually give the same fingerprint. The coarse
+    average color is appended because the hashes alone can't tell, say, a white cup from a
+    brown one.
+    """
+    rgb = image.convert("RGB")
+    red, green, blue = rgb.resize((1, 1), Image.BOX).getpixel((0, 0))
+    gray = rgb.convert("L")
+
+    small = list(gray.resize((hash_size, hash_size), Image.BILINEAR).getdata())
+    mean = sum(small) / len(small)
+    ahash = sum(1 << i for i, pixel in enumerate(small) if pixel > mean)
+
+    wide = list(gray.resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    dhash = 0
+    bit = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = wide[row * (hash_size + 1) + col]
+            right = wide[row * (hash_size + 1) + col + 1]
+            if left > right:
+                dhash |= 1 << bit
+            bit += 1
+
+    digits = hash_size * hash_size // 4
+    return f"{ahash:0{digits}x}{dhash:0{digits}x}{red >> 4:x}{green >> 4:x}{blue >> 4:x}"
+
+
+class ResultCache:
+    """
+    A bounded LRU cache whose entries also expire after `ttl_seconds`.
+
+    Entries live in process memory and, when `path` is given, in a shared SQLite file as well,
+    so a result computed by one worker can be served by the others. Values must be JSON
+    serializable. The file is read and written in a worker thread, so `get` and `set` are
+    coroutines that never block the event loop on SQLite.
+    """
+    def __init__(self, name: str, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS, path: str = None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = SQLiteStore(path, f"{name}_cache") if path else None
+
+    async def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    metrics.CACHE_LOOKUPS.inc(self.name, "hit")
+                    return value
+                del self._entries[key]
+
+        if self._store is not None:
+            try:
+                stored = await asyncio.to_thread(self._store.get, key, now)
+            except sqlite3.Error as e:
+                print(f"Error reading {self.name} cache: {e}")
+                stored = None
+            if stored is not None:
+                value, expires = stored
+                with self._lock:
+                    self._remember(key, value, expires)
+                    self.hits += 1
+                metrics.CACHE_LOOKUPS.inc(self.name, "hit")
+                return value
+
+        with self._lock:
+            self.misses += 1
+        metrics.CACHE_LOOKUPS.inc(self.name, "miss")
+        return None
+
+    async def set(self, key: str, value):
+        now = time.time()
+        expires = now + self.ttl_seconds
+        with self._lock:
+            self._remember(key, value, expires)
+        if self._store is not None:
+            try:
+                await asyncio.to_thread(self._store.set, key, value, expires, now, self.max_entries)
+            except sqlite3.Error as e:
+                print(f"Error writing {self.name} cache: {e}")
+
+    def _remember(self, key: str, value, expires: float):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class ClassifierCache:
+    """
+    The two caches used by `classifier.classify_image`: full results keyed by the exact upload
+    bytes, and Gemini categories keyed by the perceptual hash of each crop.
+    """
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS, path: str = CACHE_PATH):
+        self.frames = ResultCache("frame", max_entries, ttl_seconds, path)
+        self.crops = ResultCache("crop", max_entries, ttl_seconds, path)
+
+    def stats(self) -> dict:
+        return {"frames": self.frames.stats(), "crops": self.crops.stats()}
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers asking for the same key share one computation instead of each
+    running their own. The first caller starts it; callers arriving while it is still running
+    wait for the same result (or exception). Nothing is kept once it finishes, so this complements
+    the caches rather than replacing them.
+
+    The computation runs as its own task, so it isn't cancelled when the caller that started it
+    goes away while others are still waiting.
+    """
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key: str, factory, timeout: float = None):
+        """
+        Returns `(result, shared)`, where `shared` is True if the result came from a computation
+        started by another caller. `factory` is called without arguments to start the computation.
+        A caller joining someone else's computation waits at most `timeout` seconds, after which
+        asyncio.TimeoutError is raised (the computation itself carries on).
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            return await asyncio.wait_for(asyncio.shield(task), timeout), True
+
+        task = asyncio.ensure_future(factory())
+        self._calls[key] = task
+
+        def forget(finished):
+            if self._calls.get(key) is finished:
+                del self._calls[key]
+
+        task.add_done_callback(forget)
+        return await asyncio.shield(task), False
@@ -2,14 +2,71 @@ import os
 import json
 from PIL import Image
 import io
+import copy
+import time
+import asyncio
+from collections import deque
+import numpy as np
+from .cache import ClassifierCache, SingleFlight, exact_hash, perceptual_hash
+from .key_scheduler import GeminiKeyScheduler, SingleKey, GEMINI_KEY_WAIT_SECONDS
+from .local_model import LocalMaterialModel, crop_features
+from .tracking import ObjectTracker
+from .regions import REGION_NMS_ENABLED, postprocess_boxes
+from .replay import BackendCorpus, RecordingModel, ReplayModel, REPLAY_LATENCY_SCALE
+from . import metrics
 
-# Clarifai imports for object detection
-from clarifai_grpc.channel.clarifai_channel import ClarifaiChannel
-from clarifai_grpc.grpc.api import resources_pb2, service_pb2, service_pb2_grpc
-from clarifai_grpc.grpc.api.status import status_code_pb2
+import grpc
+# The Clarifai (object detection) and Gemini (visual analysis) SDKs are imported where they are
+# first used: google.generativeai alone takes most of a second to import, which every worker
+# would otherwise pay before it can serve anything. See `import_backends`.
 
-# Gemini import for visual analysis
-import google.generativeai as genai
+GEMINI_MODEL_NAME = 'gemini-1.5-flash-latest'
+
+# Upper bound on how many cropped objects from one image are analyzed by Gemini at the same time.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+
+# Optional hedged Gemini calls: a call still running after the GEMINI_HEDGE_PERCENTILE latency of
+# recent calls is repeated on a second key, and whichever answers first wins. Hedges spend extra
+# quota, so they are off by default. Until enough calls have been timed,
+# GEMINI_HEDGE_DEFAULT_DELAY_SECONDS is used as the delay.
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0.95"))
+GEMINI_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("GEMINI_HEDGE_MIN_DELAY_SECONDS", "0.25"))
+GEMINI_HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("GEMINI_HEDGE_DEFAULT_DELAY_SECONDS", "2.0"))
+GEMINI_HEDGE_MIN_SAMPLES = 20
+GEMINI_LATENCY_WINDOW = 200
+
+# Optional batched analysis: send all crops of an image (in groups of up to GEMINI_BATCH_MAX_CROPS)
+# to Gemini in a single request instead of one request per crop.
+GEMINI_BATCH_ENABLED = os.getenv("GEMINI_BATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+GEMINI_BATCH_MAX_CROPS = int(os.getenv("GEMINI_BATCH_MAX_CROPS", "8"))
+
+# Keepalive ping interval for the shared Clarifai channel (0 disables pings), and how many
+# detection calls may be in flight on it at once.
+CLARIFAI_KEEPALIVE_MS = int(os.getenv("CLARIFAI_KEEPALIVE_MS", "30000"))
+CLARIFAI_MAX_CONCURRENT_STREAMS = int(os.getenv("CLARIFAI_MAX_CONCURRENT_STREAMS", "32"))
+# Most images sent to Clarifai in one detection request; larger batches are split.
+CLARIFAI_MAX_BATCH_INPUTS = int(os.getenv("CLARIFAI_MAX_BATCH_INPUTS", "32"))
+
+# Alternative backend addresses, e.g. the local stand-ins used by `benchmarks/`. The insecure
+# switches connect over plaintext gRPC and must never be used with the real services.
+CLARIFAI_GRPC_INSECURE = os.getenv("CLARIFAI_GRPC_INSECURE", "false").lower() in ("1", "true", "yes")
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+GEMINI_GRPC_INSECURE = os.getenv("GEMINI_GRPC_INSECURE", "false").lower() in ("1", "true", "yes")
+
+# Uploads in these formats are forwarded to Clarifai byte-for-byte; anything else is re-encoded as JPEG.
+CLARIFAI_INPUT_FORMATS = {"JPEG", "MPO", "PNG", "WEBP", "BMP", "TIFF", "GIF"}
+# Large JPEGs are decoded at a reduced scale (at least this many pixels on the longer side) for cropping.
+DECODE_MAX_SIDE = int(os.getenv("DECODE_MAX_SIDE", "1600"))
+
+# --- Crop preparation for Gemini ---
+# Crops are downscaled to at most CROP_MAX_SIDE pixels on the longer side and sent as JPEG at
+# CROP_JPEG_QUALITY. CROP_PADDING adds that fraction of the box size as context on every side.
+# Regions smaller than CROP_MIN_SIDE pixels (in the original image) on either side are dropped.
+CROP_MAX_SIDE = int(os.getenv("CROP_MAX_SIDE", "768"))
+CROP_JPEG_QUALITY = int(os.getenv("CROP_JPEG_QUALITY", "85"))
+CROP_PADDING = float(os.getenv("CROP_PADDING", "0.0"))
+CROP_MIN_SIDE = int(os.getenv("CROP_MIN_SIDE", "12"))
 
 # This mapping helps translate the general concepts from the Clarifai model
 # into the broader categories our robot needs.
@@ -42,13 +99,227 @@ CONCEPT_TO_CATEGORY_MAP = {
     "pen": "other", "pencil": "other", "fabric": "other", "wood": "other"
 }
 
-def _get_material_from_gemini(cropped_image: Image.Image, api_key: str) -> str:
+VALID_CATEGORIES = {'paper', 'plastic', 'glass', 'metal', 'e-waste', 'organic', 'other'}
+
+# --- Tiered classification ---
+# When enabled, a region whose Clarifai concept is in CONCEPT_TO_CATEGORY_MAP and whose confidence
+# reaches that category's threshold is classified from the map directly; only the rest go to Gemini.
+# Thresholds can be overridden with e.g. FAST_PATH_THRESHOLDS="plastic=0.97,organic=0.8".
+TIERED_CLASSIFICATION_ENABLED = os.getenv("TIERED_CLASSIFICATION_ENABLED", "false").lower() in ("1", "true", "yes")
+FAST_PATH_DEFAULT_THRESHOLD = float(os.getenv("FAST_PATH_DEFAULT_THRESHOLD", "0.90"))
+
+def _parse_thresholds(spec: str) -> dict:
+    thresholds = {}
+    for entry in spec.split(","):
+        if "=" not in entry:
+            continue
+        category, value = entry.split("=", 1)
+        thresholds[category.strip().lower()] = float(value)
+    return thresholds
+
+FAST_PATH_THRESHOLDS = {
+    # "bottle" and "container" are often glass, so plastic needs more certainty.
+    "plastic": 0.95,
+    **_parse_thresholds(os.getenv("FAST_PATH_THRESHOLDS", ""))
+}
+
+def import_backends():
+    """
+    Imports the Clarifai and Gemini SDKs now rather than on first use. Under gunicorn --preload,
+    calling this while the app is loaded lets all workers share the imported modules.
+    """
+    import clarifai_grpc.channel.clarifai_channel
+    import clarifai_grpc.grpc.api.service_pb2_grpc
+    import clarifai_grpc.grpc.api.status.status_code_pb2
+    import google.generativeai
+    import google.ai.generativelanguage
+
+# One Gemini model per API key, each bound to its own client (see _get_gemini_model).
+_gemini_models = {}
+_gemini_models_loop = None
+
+# Where Gemini answers are recorded to or replayed from, and which of the two; see `use_corpus`.
+_corpus = None
+_corpus_mode = "live"
+_replay_latency_scale = REPLAY_LATENCY_SCALE
+
+def use_corpus(corpus: BackendCorpus, mode: str, latency_scale: float = REPLAY_LATENCY_SCALE):
+    """
+    Switches Gemini calls to recording into `corpus` (mode "record") or to answering from it
+    ("replay", delayed by the recorded latency times `latency_scale`), and makes `classify_images`
+    record every upload and its result when recording. Mode "live" goes back to plain calls.
+    Clarifai is switched separately, by passing a `replay.RecordingDetector` or
+    `replay.ReplayDetector` as the detector.
+    """
+    global _corpus, _corpus_mode, _replay_latency_scale
+    _corpus = corpus if mode != "live" else None
+    _corpus_mode = mode
+    _replay_latency_scale = latency_scale
+    _gemini_models.clear()
+
+def _get_gemini_model(api_key: str):
+    """
+    Returns a Gemini model that always uses the given API key.
+
+    `genai.configure` replaces a single process-wide client, so concurrent requests configuring
+    different keys would race each other. Instead, each key gets its own async client which is
+    created once and then shared by every request using that key.
     """
-    Uses Gemini Vision to classify a cropped image by its material.
+    global _gemini_models_loop
+    # gRPC asyncio channels belong to the event loop they were created on.
+    loop = asyncio.get_running_loop()
+    if loop is not _gemini_models_loop:
+        _gemini_models.clear()
+        _gemini_models_loop = loop
+
+    model = _gemini_models.get(api_key)
+    if model is None and _corpus_mode == "replay":
+        model = _gemini_models[api_key] = ReplayModel(_corpus, _replay_latency_scale)
+    if model is None:
+        import google.generativeai as genai
+        import google.ai.generativelanguage as glm
+
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        # The SDK lazily fills this in from the global configuration; pinning it here
+        # keeps the key local to this model.
+        if GEMINI_API_ENDPOINT and GEMINI_GRPC_INSECURE:
+            transport = glm.GenerativeServiceAsyncClient.get_transport_class("grpc_asyncio")
+            model._async_client = glm.GenerativeServiceAsyncClient(
+                transport=transport(channel=grpc.aio.insecure_channel(GEMINI_API_ENDPOINT))
+            )
+        else:
+            client_options = {"api_key": api_key}
+            if GEMINI_API_ENDPOINT:
+                client_options["api_endpoint"] = GEMINI_API_ENDPOINT
+            model._async_client = glm.GenerativeServiceAsyncClient(client_options=client_options)
+        if _corpus_mode == "record":
+            model = RecordingModel(model, _corpus)
+        _gemini_models[api_key] = model
+    return model
+
+async def warm_up_gemini(api_keys, timeout: float = 5.0) -> int:
+    """
+    Creates the Gemini client of every key and opens its connection ahead of the first request.
+    Returns how many connections were ready within `timeout` seconds.
+    """
+    async def ready(api_key):
+        try:
+            channel = _get_gemini_model(api_key)._async_client._client._transport.grpc_channel
+            await asyncio.wait_for(channel.channel_ready(), timeout)
+            return True
+        except Exception as e:
+            # Not fatal: the connection is opened again by the first request using this key.
+            if not isinstance(e, asyncio.TimeoutError):
+                print(f"Could not warm up a Gemini client: {e}")
+            return False
+
+    return sum(await asyncio.gather(*(ready(api_key) for api_key in api_keys)))
+
+def _image_part(crop_bytes: bytes) -> dict:
+    return {"mime_type": "image/jpeg", "data": crop_bytes}
+
+def _remaining(deadline: float):
+    """
+    Seconds left until `deadline` (a `time.monotonic()` value), or None if there is no deadline.
+    Raises TimeoutError once it has passed.
+    """
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("The request's latency budget is used up.")
+    return remaining
+
+# Recent Gemini call durations, kept separately for single-crop and batched calls.
+_gemini_latencies = {}
+
+def _hedge_delay(kind: str) -> float:
+    latencies = sorted(_gemini_latencies.get(kind, ()))
+    if len(latencies) < GEMINI_HEDGE_MIN_SAMPLES:
+        return GEMINI_HEDGE_DEFAULT_DELAY_SECONDS
+    index = min(len(latencies) - 1, int(GEMINI_HEDGE_PERCENTILE * len(latencies)))
+    return max(GEMINI_HEDGE_MIN_DELAY_SECONDS, latencies[index])
+
+def _consume_exception(task: asyncio.Task):
+    # Calls that lost the race or outlived their caller still end with an exception to read.
+    if not task.cancelled():
+        task.exception()
+
+async def _call_gemini(gemini_keys, api_key: str, contents, kind: str, deadline: float, **kwargs):
+    timeout = _remaining(deadline)
+    model = _get_gemini_model(api_key)
+    metrics.count("gemini_calls")
+    if timeout is not None:
+        kwargs["request_options"] = {"timeout": timeout}
+    start = time.monotonic()
+    try:
+        response = await model.generate_content_async(contents, **kwargs)
+    except Exception as e:
+        metrics.BACKEND_ERRORS.inc("gemini")
+        await gemini_keys.report_failure(api_key, e)
+        raise
+    _gemini_latencies.setdefault(kind, deque(maxlen=GEMINI_LATENCY_WINDOW)).append(time.monotonic() - start)
+    await gemini_keys.report_success(api_key)
+    return response
+
+async def _generate(gemini_keys, contents, kind: str = "single", deadline: float = None, slots: asyncio.Semaphore = None, **kwargs):
+    """
+    Makes one Gemini call using a key picked by `gemini_keys` (a GeminiKeyScheduler or SingleKey)
+    and reports the outcome back so throttled or failing keys can be rested.
+
+    With hedging enabled, a call that takes longer than most recent calls of the same `kind` is
+    sent again on a different key, if one is free right away. The hedge needs a free slot in
+    `slots` (the semaphore bounding concurrent Gemini calls) and is skipped otherwise. The first
+    successful answer is returned and the other call is cancelled. No call is allowed to run past
+    `deadline`.
     """
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-1.5-flash-latest')
+    wait = _remaining(deadline)
+    api_key = await gemini_keys.acquire(timeout=GEMINI_KEY_WAIT_SECONDS if wait is None else min(wait, GEMINI_KEY_WAIT_SECONDS))
+    calls = [asyncio.ensure_future(_call_gemini(gemini_keys, api_key, contents, kind, deadline, **kwargs))]
+    calls[0].add_done_callback(_consume_exception)
+    try:
+        if GEMINI_HEDGE_ENABLED:
+            done, _ = await asyncio.wait(calls, timeout=_hedge_delay(kind))
+            if not done and (slots is None or not slots.locked()):
+                if slots is not None:
+                    await slots.acquire()
+                hedge = None
+                try:
+                    _remaining(deadline)
+                    hedge_key = await gemini_keys.acquire(timeout=0, exclude=(api_key,))
+                    hedge = asyncio.ensure_future(_call_gemini(gemini_keys, hedge_key, contents, kind, deadline, **kwargs))
+                except TimeoutError:
+                    pass
+                finally:
+                    if slots is not None:
+                        if hedge is None:
+                            slots.release()
+                        else:
+                            hedge.add_done_callback(lambda _: slots.release())
+                if hedge is not None:
+                    metrics.GEMINI_HEDGES.inc(kind)
+                    hedge.add_done_callback(_consume_exception)
+                    calls.append(hedge)
+
+        pending = set(calls)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for call in done:
+                if call.exception() is None:
+                    return call.result()
+            if not pending:
+                # Every call failed; report the most recent failure.
+                raise done.pop().exception()
+    finally:
+        for call in calls:
+            if not call.done():
+                call.cancel()
 
+async def _get_material_from_gemini(crop_bytes: bytes, gemini_keys, deadline: float = None, slots: asyncio.Semaphore = None) -> str:
+    """
+    Uses Gemini Vision to classify a cropped image (JPEG bytes) by its material. Returns None if
+    `deadline` passed before an answer arrived. `slots` is passed on to `_generate` for hedging.
+    """
     prompt = """
     Analyze the object in this image and classify it by its primary material.
     You MUST respond with a single word from this strict list:
@@ -57,94 +328,718 @@ def _get_material_from_gemini(cropped_image: Image.Image, api_key: str) -> str:
     Do not provide any explanation or other text. Just the single-word category.
     """
     try:
-        response = model.generate_content([prompt, cropped_image])
+        response = await _generate(gemini_keys, [prompt, _image_part(crop_bytes)], deadline=deadline, slots=slots)
         category = response.text.strip().lower()
         # Basic validation to ensure the model returns a valid category
-        valid_categories = {'paper', 'plastic', 'glass', 'metal', 'e-waste', 'organic', 'other'}
-        if category in valid_categories:
+        if category in VALID_CATEGORIES:
             return category
         else:
             return "other" # Default to 'other' if the response is invalid
     except Exception as e:
+        if deadline is not None and time.monotonic() >= deadline:
+            return None  # Out of time rather than a failed analysis.
         print(f"Error during Gemini material analysis: {e}")
         return "error"
 
-def classify_image(image: Image.Image, clarifai_pat: str, gemini_api_key: str):
+async def _get_materials_from_gemini_batch(cropped_images, gemini_keys, deadline: float = None, slots: asyncio.Semaphore = None):
     """
-    Orchestrates a two-step "crop and classify" process:
-    1. Detects objects and their bounding boxes using Clarifai.
-    2. For each detected object, crops it and sends the image to Gemini for material classification.
+    Uses a single Gemini Vision request to classify several cropped images (JPEG bytes) at once.
+
+    Returns one category per crop in the same order, or None if the answer can't be trusted
+    (the call failed, the reply wasn't a JSON list, or it has the wrong number of entries).
     """
-    CONFIDENCE_THRESHOLD = 0.60
-    trash_items = []
-    debug_info = {
-        "confidence_threshold": CONFIDENCE_THRESHOLD,
-        "clarifai_detections": [],
-        "final_classifications": []
-    }
+    prompt = f"""
+    You will be shown {len(cropped_images)} images, each containing one object.
+    Classify each object by its primary material, using only this strict list:
+    `paper`, `plastic`, `glass`, `metal`, `e-waste`, `organic`, `other`.
 
-    # --- Step 1: Detect object locations with Clarifai ---
+    Respond with a JSON list of exactly {len(cropped_images)} strings, one category per image,
+    in the same order as the images. For example: ["plastic", "paper"].
+    Do not provide any explanation or other text.
+    """
+    contents = [prompt]
+    for i, crop_bytes in enumerate(cropped_images, start=1):
+        contents += [f"Image {i}:", _image_part(crop_bytes)]
+
+    try:
+        response = await _generate(
+            gemini_keys,
+            contents,
+            kind="batch",
+            deadline=deadline,
+            slots=slots,
+            generation_config={"response_mime_type": "application/json"}
+        )
+        categories = json.loads(response.text)
+    except Exception as e:
+        print(f"Error during batched Gemini material analysis: {e}")
+        return None
+
+    if not isinstance(categories, list) or len(categories) != len(cropped_images):
+        print("Batched Gemini response did not match the number of crops.")
+        return None
+
+    return [
+        category.strip().lower() if isinstance(category, str) and category.strip().lower() in VALID_CATEGORIES else "other"
+        for category in categories
+    ]
+
+async def _gather_until(coroutines, deadline: float = None):
+    """
+    Like `asyncio.gather`, but stops waiting at `deadline`: anything still running then is
+    cancelled and gives None.
+    """
+    if deadline is None:
+        return await asyncio.gather(*coroutines)
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    if not tasks:
+        return []
     try:
-        channel = ClarifaiChannel.get_grpc_channel()
-        stub = service_pb2_grpc.V2Stub(channel)
+        done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    return [task.result() if task in done else None for task in tasks]
+
+async def _analyze_crops(cropped_images, gemini_keys, semaphore: asyncio.Semaphore, batch: bool = False, deadline: float = None):
+    """
+    Runs the Gemini material analysis for several crops concurrently, with at most as many
+    requests in flight as `semaphore` allows. Categories are returned in the same order as the crops.
+
+    With `batch`, crops are sent in groups of up to GEMINI_BATCH_MAX_CROPS per request. A group
+    whose batched answer can't be used falls back to one request per crop.
+
+    Byte-identical crops are only analyzed once and share the answer. Crops not analyzed by
+    `deadline` get None.
+    """
+    digests = [exact_hash(crop) for crop in cropped_images]
+    unique = list(dict(zip(digests, cropped_images)).items())
+    if len(unique) < len(cropped_images):
+        metrics.COALESCED.inc("crop", amount=len(cropped_images) - len(unique))
+        categories = dict(zip(
+            (digest for digest, _ in unique),
+            await _analyze_crops([crop for _, crop in unique], gemini_keys, semaphore, batch, deadline)
+        ))
+        return [categories[digest] for digest in digests]
+
+    async def analyze(crop):
+        async with semaphore:
+            return await _get_material_from_gemini(crop, gemini_keys, deadline, semaphore)
+
+    async def analyze_group(group):
+        if len(group) > 1:
+            async with semaphore:
+                categories = await _get_materials_from_gemini_batch(group, gemini_keys, deadline, semaphore)
+            if categories is not None:
+                return categories
+        return await asyncio.gather(*(analyze(crop) for crop in group))
+
+    if not batch:
+        return await _gather_until([analyze(crop) for crop in cropped_images], deadline)
+
+    group_size = max(1, GEMINI_BATCH_MAX_CROPS)
+    groups = [cropped_images[i:i + group_size] for i in range(0, len(cropped_images), group_size)]
+    results = await _gather_until([analyze_group(group) for group in groups], deadline)
+    return [
+        category
+        for group, categories in zip(groups, results)
+        for category in (categories if categories is not None else [None] * len(group))
+    ]
+
+class ClarifaiDetector:
+    """
+    Keeps one long-lived gRPC channel and `V2Stub` to Clarifai so detection calls only pay for
+    the RPC itself, not for a fresh TLS/HTTP2 handshake on every image.
+
+    The channel is checked before each call and rebuilt if it has failed or been shut down, and
+    a call that fails with a connection-level error is retried once on a fresh channel.
+    """
+    # gRPC status codes that point at a broken connection rather than a bad request.
+    RECONNECT_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.INTERNAL, grpc.StatusCode.UNKNOWN)
+
+    def __init__(self, base: str = None, keepalive_ms: int = CLARIFAI_KEEPALIVE_MS, max_concurrent_streams: int = CLARIFAI_MAX_CONCURRENT_STREAMS):
+        self.base = base or os.getenv("CLARIFAI_GRPC_BASE", "api.clarifai.com")
+        self.keepalive_ms = keepalive_ms
+        self._streams = asyncio.Semaphore(max(1, max_concurrent_streams))
+        self._rebuild_lock = asyncio.Lock()
+        self.channel = None
+        self.stub = None
+        self.rebuilds = 0
+        self._connect()
+
+    def _connect(self):
+        from clarifai_grpc.channel import clarifai_channel
+        from clarifai_grpc.grpc.api import service_pb2_grpc
+
+        options = [
+            ("grpc.service_config", clarifai_channel.grpc_json_config),
+            ("grpc.max_receive_message_length", clarifai_channel.MAX_MESSAGE_LENGTH),
+            ("grpc.max_send_message_length", clarifai_channel.MAX_MESSAGE_LENGTH),
+        ]
+        if self.keepalive_ms > 0:
+            options += [
+                ("grpc.keepalive_time_ms", self.keepalive_ms),
+                ("grpc.keepalive_timeout_ms", 10000),
+                ("grpc.keepalive_permit_without_calls", 1),
+                ("grpc.http2.max_pings_without_data", 0),
+            ]
+        # V2Stub picks its response deserializer from this module global, which the
+        # ClarifaiChannel factories normally set for us.
+        clarifai_channel.wrap_response_deserializer = clarifai_channel._response_deserializer_for_grpc
+        if CLARIFAI_GRPC_INSECURE:
+            self.channel = grpc.aio.insecure_channel(self.base, options=options)
+        else:
+            self.channel = grpc.aio.secure_channel(self.base, grpc.ssl_channel_credentials(), options=options)
+        self.stub = service_pb2_grpc.V2Stub(self.channel)
+
+    def is_healthy(self) -> bool:
+        state = self.channel.get_state(try_to_connect=False)
+        return state not in (grpc.ChannelConnectivity.TRANSIENT_FAILURE, grpc.ChannelConnectivity.SHUTDOWN)
+
+    async def _rebuild(self, broken_channel):
+        async with self._rebuild_lock:
+            # Another request may already have replaced the channel while we waited.
+            if self.channel is not broken_channel:
+                return
+            print(f"Rebuilding Clarifai gRPC channel to {self.base}.")
+            self._connect()
+            self.rebuilds += 1
+            await broken_channel.close()
+
+    async def warm_up(self, timeout: float = 5.0) -> bool:
+        """
+        Opens the connection ahead of the first request. Returns False if it isn't ready in time.
+        """
+        try:
+            await asyncio.wait_for(self.channel.channel_ready(), timeout)
+            return True
+        except (asyncio.TimeoutError, grpc.aio.AioRpcError):
+            return False
+
+    async def detect(self, images, clarifai_pat: str, deadline: float = None):
+        """
+        Sends one or more encoded images to Clarifai's general detection model in a single request
+        and returns the response, which has one output per image in the same order. With a
+        `deadline`, the call fails with DEADLINE_EXCEEDED (or TimeoutError) once it passes.
+        """
+        from clarifai_grpc.grpc.api import resources_pb2, service_pb2
+
+        request = service_pb2.PostModelOutputsRequest(
+            user_app_id=resources_pb2.UserAppIDSet(user_id="clarifai", app_id="main"),
+            model_id='general-image-detection',
+            version_id='1580bb1932594c93b7e2e04456af7c6f',
+            inputs=[resources_pb2.Input(data=resources_pb2.Data(image=resources_pb2.Image(base64=image_bytes))) for image_bytes in images]
+        )
         metadata = (('authorization', 'Key ' + clarifai_pat),)
-        
+
+        async with self._streams:
+            if not self.is_healthy():
+                await self._rebuild(self.channel)
+            channel = self.channel
+            try:
+                return await self.stub.PostModelOutputs(request, metadata=metadata, timeout=_remaining(deadline))
+            except grpc.aio.AioRpcError as e:
+                if e.code() not in self.RECONNECT_CODES:
+                    raise
+                await self._rebuild(channel)
+                return await self.stub.PostModelOutputs(request, metadata=metadata, timeout=_remaining(deadline))
+
+    async def close(self):
+        await self.channel.close()
+
+def _is_deadline_error(error: Exception) -> bool:
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, grpc.aio.AioRpcError) and error.code() == grpc.StatusCode.DEADLINE_EXCEEDED
+
+def _can_forward(header: Image.Image) -> bool:
+    """
+    Whether an upload can go to Clarifai as-is. `header` is an image opened with `Image.open`
+    but not yet loaded, so this only looks at the file header.
+    """
+    if header.format not in CLARIFAI_INPUT_FORMATS:
+        return False
+    # A rotated photo would be detected in a different orientation than the one we crop from.
+    return header.getexif().get(0x0112, 1) == 1
+
+def _decode_image(image_bytes: bytes, max_side: int = DECODE_MAX_SIDE) -> Image.Image:
+    """
+    Decodes the upload to RGB pixels. Large JPEGs are decoded directly at a reduced scale
+    (PIL draft mode), which is much cheaper than decoding at full size; bounding boxes are
+    normalized, so crops line up either way.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    width, height = image.size
+    if image.format in ("JPEG", "MPO") and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        image.draft("RGB", (int(width * scale), int(height * scale)))
+    return image.convert("RGB")
+
+def _encode_jpeg(image_bytes: bytes) -> bytes:
+    byte_arr = io.BytesIO()
+    _decode_image(image_bytes, max_side=float("inf")).save(byte_arr, format='JPEG')
+    return byte_arr.getvalue()
+
+def _is_too_small(region, image_size) -> bool:
+    box = region.region_info.bounding_box
+    width = (box.right_col - box.left_col) * image_size[0]
+    height = (box.bottom_row - box.top_row) * image_size[1]
+    return min(width, height) < CROP_MIN_SIDE
+
+def _prepare_crops(image: Image.Image, regions):
+    """
+    Cuts each region's bounding box (plus CROP_PADDING context) out of the image, downscales it to
+    CROP_MAX_SIDE and encodes it as JPEG. Returns a list of (crop image, JPEG bytes) pairs.
+    """
+    img_width, img_height = image.size
+    prepared = []
+    for region in regions:
+        box = region.region_info.bounding_box
+        pad_x = (box.right_col - box.left_col) * CROP_PADDING
+        pad_y = (box.bottom_row - box.top_row) * CROP_PADDING
+
+        left = int(max(0.0, box.left_col - pad_x) * img_width)
+        top = int(max(0.0, box.top_row - pad_y) * img_height)
+        right = int(min(1.0, box.right_col + pad_x) * img_width)
+        bottom = int(min(1.0, box.bottom_row + pad_y) * img_height)
+
+        crop = image.crop((left, top, right, bottom))
+        crop.thumbnail((CROP_MAX_SIDE, CROP_MAX_SIDE))
+
         byte_arr = io.BytesIO()
-        image.save(byte_arr, format='JPEG')
-
-        post_model_outputs_response = stub.PostModelOutputs(
-            service_pb2.PostModelOutputsRequest(
-                user_app_id=resources_pb2.UserAppIDSet(user_id="clarifai", app_id="main"),
-                model_id='general-image-detection',
-                version_id='1580bb1932594c93b7e2e04456af7c6f',
-                inputs=[resources_pb2.Input(data=resources_pb2.Data(image=resources_pb2.Image(base64=byte_arr.getvalue())))]
-            ),
-            metadata=metadata
-        )
+        crop.save(byte_arr, format='JPEG', quality=CROP_JPEG_QUALITY)
+        prepared.append((crop, byte_arr.getvalue()))
+    return prepared
+
+def _fast_path_category(region):
+    """
+    Returns the category for a region straight from CONCEPT_TO_CATEGORY_MAP, or None if the
+    concept isn't mapped or Clarifai isn't confident enough to skip Gemini.
+    """
+    concept = region.data.concepts[0]
+    category = CONCEPT_TO_CATEGORY_MAP.get(concept.name.lower())
+    if category is None:
+        return None
+    if concept.value < FAST_PATH_THRESHOLDS.get(category, FAST_PATH_DEFAULT_THRESHOLD):
+        return None
+    return category
+
+def _hash_crops(prepared_crops):
+    return [perceptual_hash(crop) for crop, _ in prepared_crops]
+
+CONFIDENCE_THRESHOLD = 0.60
+
+def _postprocess_regions(regions, detections, debug_info: dict):
+    """
+    Removes duplicate and contained regions (see `regions.postprocess_boxes`). Each removed
+    region's entry in `detections` (if it has one) is marked with the reason, and a region that absorbed others
+    is returned as a copy with the enlarged box.
+    """
+    from clarifai_grpc.grpc.api import resources_pb2
+
+    boxes = []
+    for region in regions:
+        box = region.region_info.bounding_box
+        boxes.append([box.left_col, box.top_row, box.right_col, box.bottom_row])
+    kept, merged_boxes, reasons = postprocess_boxes(
+        boxes,
+        [region.data.concepts[0].value for region in regions],
+        labels=[region.data.concepts[0].name for region in regions]
+    )
 
-        if post_model_outputs_response.status.code != status_code_pb2.SUCCESS:
-            return {"error": f"Clarifai API error: {post_model_outputs_response.status.description}"}
+    removed = {}
+    for detection, reason in zip(detections, reasons):
+        if reason is not None:
+            if detection is not None:
+                detection["dropped"] = reason
+            removed[reason] = removed.get(reason, 0) + 1
+            metrics.REGIONS_REMOVED.inc(reason)
+    debug_info["regions"] = {"candidates": len(regions), "kept": len(kept), "removed": removed}
 
-        high_confidence_regions = []
-        for region in post_model_outputs_response.outputs[0].data.regions:
-            concept = region.data.concepts[0]
-            confidence = concept.value
-            debug_info["clarifai_detections"].append({"name": concept.name.lower(), "confidence": f"{confidence:.2f}"})
-            if confidence > CONFIDENCE_THRESHOLD:
+    result = []
+    for index, merged in zip(kept, merged_boxes):
+        region = regions[index]
+        if list(merged) != boxes[index]:
+            region = resources_pb2.Region()
+            region.CopyFrom(regions[index])
+            box = region.region_info.bounding_box
+            box.left_col, box.top_row, box.right_col, box.bottom_row = (float(value) for value in merged)
+        result.append(region)
+    return result
+
+def _predict_locally(local_model: LocalMaterialModel, crop_images):
+    features = np.stack([crop_features(image) for image in crop_images])
+    return features, local_model.predict(features)
+
+async def _classify_regions(image_bytes: bytes, header: Image.Image, output, debug_info: dict, frame_key: str, gemini_keys, semaphore: asyncio.Semaphore, batch: bool, cache: ClassifierCache, tiered: bool, local_model: LocalMaterialModel = None, tracker: ObjectTracker = None, session_id: str = None, deadline: float = None, debug: bool = True):
+    """
+    Step 2 for one image: turns Clarifai's detections into classified trash items.
+    """
+    trash_items = []
+    high_confidence_regions = []
+    candidates = []
+    for region in output.data.regions:
+        concept = region.data.concepts[0]
+        confidence = concept.value
+        detection = None
+        if debug:
+            detection = {"name": concept.name.lower(), "confidence": f"{confidence:.2f}"}
+            debug_info["clarifai_detections"].append(detection)
+        if confidence > CONFIDENCE_THRESHOLD:
+            if _is_too_small(region, header.size):
+                if detection is not None:
+                    detection["dropped"] = "too_small"
+                metrics.REGIONS_REMOVED.inc("too_small")
+            else:
                 high_confidence_regions.append(region)
+                candidates.append(detection)
+    if REGION_NMS_ENABLED and high_confidence_regions:
+        with metrics.stage("regions"):
+            high_confidence_regions = _postprocess_regions(high_confidence_regions, candidates, debug_info)
+    metrics.REGIONS_PER_IMAGE.observe(len(high_confidence_regions))
 
-    except Exception as e:
-        return {"error": f"An internal error occurred during Clarifai detection: {str(e)}"}
+    detections = []
+    for region in high_confidence_regions:
+        box = region.region_info.bounding_box
+        detections.append((region.data.concepts[0].name.lower(), [box.left_col, box.top_row, box.right_col, box.bottom_row]))
+
+    categories = [None] * len(high_confidence_regions)
+    decided_by = [None] * len(high_confidence_regions)
+    track_ids = None
+    if tracker is not None and session_id:
+        session, assigned = await tracker.match(session_id, detections)
+        track_ids = [track_id for track_id, _ in assigned]
+        for i, (_, category) in enumerate(assigned):
+            if category is not None:
+                categories[i] = category
+                decided_by[i] = "track"
+        debug_info["tracking"] = {"session_id": session_id}
 
-    # --- Step 2: Crop and Classify each detected object with Gemini ---
     if not high_confidence_regions:
-        debug_info["final_classifications"].append("No objects passed confidence threshold.")
+        if track_ids is not None:
+            await tracker.update(session_id, session, [], [], [])
+            debug_info["tracking"]["active_tracks"] = len(session["tracks"])
+        if debug:
+            debug_info["final_classifications"].append("No objects passed confidence threshold.")
+        if frame_key is not None:
+            debug_info["cache"]["totals"] = cache.stats()
+            await cache.frames.set(frame_key, copy.deepcopy({"trash_items": [], "debug_info": debug_info}))
         return {"trash_items": [], "debug_info": debug_info}
 
-    img_width, img_height = image.size
-    for region in high_confidence_regions:
-        box = region.region_info.bounding_box
-        
-        left = int(box.left_col * img_width)
-        top = int(box.top_row * img_height)
-        right = int(box.right_col * img_width)
-        bottom = int(box.bottom_row * img_height)
-        
-        cropped_image = image.crop((left, top, right, bottom))
-        
-        category = _get_material_from_gemini(cropped_image, gemini_api_key)
-        
-        clarifai_name = region.data.concepts[0].name.lower()
-        debug_info["final_classifications"].append({"clarifai_name": clarifai_name, "gemini_category": category})
-
-        if category != "error":
-            trash_items.append({
-                "category": category,
-                "bounding_box": [box.left_col, box.top_row, box.right_col, box.bottom_row]
-            })
+    if tiered:
+        for i, region in enumerate(high_confidence_regions):
+            if categories[i] is None:
+                categories[i] = _fast_path_category(region)
+                if categories[i] is not None:
+                    decided_by[i] = "concept_map"
+
+    remaining = [i for i, category in enumerate(categories) if category is None]
+    prepared_crops = []
+    if remaining:
+        with metrics.stage("decode"):
+            image = await asyncio.to_thread(_decode_image, image_bytes)
+        debug_info["ingest"]["decoded_size"] = list(image.size)
+        with metrics.stage("crop"):
+            prepared_crops = await asyncio.to_thread(_prepare_crops, image, [high_confidence_regions[i] for i in remaining])
+    crops = dict(zip(remaining, prepared_crops))
+
+    if cache is not None:
+        with metrics.stage("crop_hash"):
+            crop_keys = dict(zip(remaining, await asyncio.to_thread(_hash_crops, prepared_crops)))
+        cached = await asyncio.gather(*(cache.crops.get(crop_keys[i]) for i in remaining))
+        for i, category in zip(remaining, cached):
+            categories[i] = category
+            if category is not None:
+                decided_by[i] = "cache"
+
+    local_guesses = {}
+    unresolved = [i for i in remaining if categories[i] is None]
+    if local_model is not None and unresolved:
+        with metrics.stage("local_model"):
+            features, predictions = await asyncio.to_thread(_predict_locally, local_model, [crops[i][0] for i in unresolved])
+        features = dict(zip(unresolved, features))
+        for i, (category, confidence) in zip(unresolved, predictions):
+            if category is None:
+                continue
+            local_guesses[i] = {"category": category, "confidence": confidence}
+            if local_model.is_confident(confidence):
+                categories[i] = category
+                decided_by[i] = "local_model"
+
+    pending = [i for i in remaining if categories[i] is None]
+    with metrics.stage("gemini"):
+        analyzed = await _analyze_crops([crops[i][1] for i in pending], gemini_keys, semaphore, batch, deadline)
+    for i, category in zip(pending, analyzed):
+        categories[i] = category
+        # None means the crop was still being analyzed when the deadline passed.
+        decided_by[i] = "gemini" if category is not None else "deadline"
+        if category in (None, "error"):
+            continue
+        if i in local_guesses:
+            metrics.LOCAL_MODEL_AGREEMENT.inc("agree" if local_guesses[i]["category"] == category else "disagree")
+
+    if cache is not None:
+        await asyncio.gather(*(cache.crops.set(crop_keys[i], categories[i]) for i in pending if categories[i] not in (None, "error")))
+
+    if local_model is not None:
+        # Gemini's answers become training examples for the local model.
+        learned = [i for i in pending if categories[i] not in (None, "error")]
+        if learned:
+            await asyncio.to_thread(local_model.add, [features[i] for i in learned], [categories[i] for i in learned])
 
+    for i, ((clarifai_name, box), category, tier) in enumerate(zip(detections, categories, decided_by)):
+        if debug:
+            classification = {"clarifai_name": clarifai_name, "category": category, "decided_by": tier}
+            if i in crops:
+                classification["crop_bytes"] = len(crops[i][1])
+            if i in local_guesses:
+                classification["local_model"] = local_guesses[i]
+            if track_ids is not None:
+                classification["track_id"] = track_ids[i]
+            debug_info["final_classifications"].append(classification)
+
+        if category not in (None, "error"):
+            item = {"category": category, "bounding_box": box}
+            if track_ids is not None:
+                item["track_id"] = track_ids[i]
+            trash_items.append(item)
+
+    if track_ids is not None:
+        await tracker.update(session_id, session, detections, track_ids, categories)
+        debug_info["tracking"]["active_tracks"] = len(session["tracks"])
+
+    debug_info["tiers"] = {tier: decided_by.count(tier) for tier in ("track", "concept_map", "cache", "local_model", "gemini", "deadline")}
+    for tier, decided in debug_info["tiers"].items():
+        if decided:
+            metrics.TIER_DECISIONS.inc(tier, amount=decided)
+    debug_info["gemini_payload_bytes"] = sum(len(crops[i][1]) for i in pending)
+
+    if cache is not None:
+        debug_info["cache"]["crop_hits"] = len(remaining) - len(pending)
+        debug_info["cache"]["crop_misses"] = len(pending)
+        debug_info["cache"]["totals"] = cache.stats()
+        # Only complete results are worth replaying for a repeated upload.
+        if frame_key is not None and "error" not in categories and None not in categories:
+            await cache.frames.set(frame_key, copy.deepcopy({"trash_items": trash_items, "debug_info": debug_info}))
+
+    if None in categories:
+        debug_info["deadline_hit"] = "gemini"
+        return {"trash_items": trash_items, "debug_info": debug_info, "incomplete": True}
     return {"trash_items": trash_items, "debug_info": debug_info}
 
+def _frame_key(image_bytes: bytes, debug: bool) -> str:
+    # Results without debug details are cached and shared separately from full ones.
+    key = exact_hash(image_bytes)
+    return key if debug else f"{key}:compact"
+
+async def classify_images(images, clarifai_pat: str, gemini_api_key: str = None, detector: ClarifaiDetector = None, max_concurrency: int = GEMINI_MAX_CONCURRENCY, batch: bool = GEMINI_BATCH_ENABLED, cache: ClassifierCache = None, tiered: bool = TIERED_CLASSIFICATION_ENABLED, key_scheduler: GeminiKeyScheduler = None, local_model: LocalMaterialModel = None, tracker: ObjectTracker = None, sessions=None, deadline: float = None, debug: bool = True):
+    """
+    Orchestrates a two-step "crop and classify" process for one or more uploaded images:
+    1. Detects objects and their bounding boxes using Clarifai (through `detector`, normally the
+       shared one created at startup; a temporary one is used if none is given). All images go
+       to Clarifai together, in as few requests as CLARIFAI_MAX_BATCH_INPUTS allows.
+    2. For each detected object, crops it (dropping slivers, see the CROP_* settings) and sends the
+       crop to Gemini as JPEG bytes for material classification. Up to `max_concurrency` crops
+       (across all images) are analyzed in parallel, or, with `batch`, grouped into as few
+       multi-image requests as possible. Each Gemini call gets its own key from `key_scheduler`;
+       without one, every call uses `gemini_api_key`.
+
+    Each entry of `images` is an uploaded file. If Clarifai accepts its format it is sent unchanged,
+    and pixels are only decoded once there is something to crop.
+
+    Network calls are awaited and the CPU-bound image work (decoding, cropping) runs in a
+    worker thread, so the event loop stays free to serve other requests in the meantime.
+
+    With a `cache`, an upload whose exact bytes were classified recently returns
+    the earlier result without calling either service, and crops that look the same as a recently
+    analyzed crop reuse its category instead of going to Gemini.
+
+    With `tiered`, confidently detected objects whose concept is in CONCEPT_TO_CATEGORY_MAP are
+    classified from the map without Gemini. Each entry of `final_classifications` records which
+    tier decided it (`track`, `concept_map`, `cache`, `local_model` or `gemini`).
+
+    With a `tracker`, `sessions` gives an optional session ID per image. Detections in a session
+    are matched to the objects seen in its previous frames (see `tracking.ObjectTracker`); every
+    item gets a `track_id` that stays the same while the object stays in view, and objects that
+    haven't moved keep their category without being analyzed again. Images with a session skip
+    the whole-frame cache, whose results carry no track IDs.
+
+    With a `local_model`, every crop Gemini classifies is stored as a training example, and crops
+    the model is confident about are classified locally instead. Its guess and confidence are
+    reported in `final_classifications` under `local_model` whenever it has one.
+
+    With a `deadline` (a `time.monotonic()` value), every Clarifai and Gemini call is bounded by the
+    time left, and Gemini calls that are slow compared to recent ones are hedged on a second key.
+    Whatever isn't finished when the deadline passes is left out: the result then carries
+    `"incomplete": true`, and `debug_info.deadline_hit` names the stage that ran out of time.
+    Objects that were detected but not classified are listed in `final_classifications` with
+    `"decided_by": "deadline"`.
+
+    Without `debug`, the per-detection lists of the debug info (`clarifai_detections` and
+    `final_classifications`) are left empty, for callers that only return the trash items.
+
+    Returns one result per image, in order. A result is either `{"trash_items", "debug_info"}`
+    (plus `incomplete` when cut short) or `{"error": ...}`.
+    """
+    from clarifai_grpc.grpc.api.status import status_code_pb2
+
+    started = time.monotonic()
+    results = [None] * len(images)
+    states = {}
+    gemini_keys = key_scheduler or SingleKey(gemini_api_key)
+
+    for index, image_bytes in enumerate(images):
+        debug_info = {
+            "confidence_threshold": CONFIDENCE_THRESHOLD,
+            "clarifai_detections": [],
+            "final_classifications": []
+        }
+
+        session_id = sessions[index] if sessions else None
+        frame_key = None
+        if cache is not None:
+            debug_info["cache"] = {"frame_hit": False, "crop_hits": 0, "crop_misses": 0}
+        if cache is not None and not (tracker is not None and session_id):
+            frame_key = _frame_key(image_bytes, debug)
+            cached_result = await cache.frames.get(frame_key)
+            if cached_result is not None:
+                result = copy.deepcopy(cached_result)
+                result["debug_info"]["cache"] = {"frame_hit": True, "crop_hits": 0, "crop_misses": 0, "totals": cache.stats()}
+                results[index] = result
+                continue
+
+        try:
+            # Only reads the header; pixels are decoded later, if at all.
+            header = Image.open(io.BytesIO(image_bytes))
+        except Exception as e:
+            metrics.BACKEND_ERRORS.inc("decode")
+            results[index] = {"error": f"Could not read the uploaded image: {str(e)}"}
+            continue
+        debug_info["ingest"] = {"format": header.format, "size": list(header.size), "forwarded_original": _can_forward(header)}
+        states[index] = (header, debug_info, frame_key)
+
+    # --- Step 1: Detect object locations with Clarifai ---
+    pending = list(states)
+    outputs = {}
+    try:
+        detection_inputs = []
+        for index in pending:
+            if states[index][1]["ingest"]["forwarded_original"]:
+                detection_inputs.append(images[index])
+            else:
+                with metrics.stage("reencode"):
+                    detection_inputs.append(await asyncio.to_thread(_encode_jpeg, images[index]))
+
+        owns_detector = detector is None
+        if owns_detector:
+            detector = ClarifaiDetector()
+        try:
+            group_size = max(1, CLARIFAI_MAX_BATCH_INPUTS)
+            for start in range(0, len(pending), group_size):
+                group = pending[start:start + group_size]
+                with metrics.stage("clarifai"):
+                    post_model_outputs_response = await detector.detect(detection_inputs[start:start + group_size], clarifai_pat, deadline)
+
+                # MIXED_STATUS means some inputs failed; those are reported per output below.
+                if post_model_outputs_response.status.code not in (status_code_pb2.SUCCESS, status_code_pb2.MIXED_STATUS):
+                    metrics.BACKEND_ERRORS.inc("clarifai")
+                    for index in group:
+                        results[index] = {"error": f"Clarifai API error: {post_model_outputs_response.status.description}"}
+                    continue
+
+                mixed = post_model_outputs_response.status.code == status_code_pb2.MIXED_STATUS
+                for index, output in zip(group, post_model_outputs_response.outputs):
+                    if mixed and output.status.code != status_code_pb2.SUCCESS:
+                        metrics.BACKEND_ERRORS.inc("clarifai")
+                        results[index] = {"error": f"Clarifai API error: {output.status.description}"}
+                    else:
+                        outputs[index] = output
+        finally:
+            if owns_detector:
+                await detector.close()
+
+    except Exception as e:
+        if not _is_deadline_error(e):
+            metrics.BACKEND_ERRORS.inc("clarifai")
+            for index in pending:
+                if results[index] is None:
+                    results[index] = {"error": f"An internal error occurred during Clarifai detection: {str(e)}"}
+            return results
+        # Out of time: images still waiting for detection come back empty but marked as such,
+        # and images that were already detected continue with whatever time is left.
+        for index in pending:
+            if results[index] is None and index not in outputs:
+                debug_info = states[index][1]
+                debug_info["deadline_hit"] = "clarifai"
+                results[index] = {"trash_items": [], "debug_info": debug_info, "incomplete": True}
+
+    # --- Step 2: Crop and Classify each detected object with Gemini ---
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def classify_regions(index):
+        session_id = sessions[index] if sessions else None
+        classify = _classify_regions(images[index], states[index][0], outputs[index], states[index][1], states[index][2], gemini_keys, semaphore, batch, cache, tiered, local_model,
+                                     tracker, session_id, deadline, debug)
+        if tracker is None or not session_id:
+            return await classify
+        # The session's tracks are read before the Gemini calls and written back after them.
+        async with tracker.lock(session_id):
+            return await classify
+
+    classified = await asyncio.gather(*(classify_regions(index) for index in outputs))
+    for index, result in zip(outputs, classified):
+        results[index] = result
+
+    if _corpus_mode == "record":
+        elapsed = time.monotonic() - started
+        for image_bytes, result in zip(images, results):
+            await asyncio.to_thread(_corpus.record_request, image_bytes, result, elapsed)
+
+    return results
+
+async def classify_image(image_bytes: bytes, clarifai_pat: str, gemini_api_key: str = None, session_id: str = None, coalescer: SingleFlight = None, **kwargs):
+    """
+    Classifies a single uploaded image. See `classify_images` for the pipeline and options.
+
+    With a `coalescer`, concurrent calls for the same image bytes (e.g. a client retrying while
+    its first request is still running) share one run of the pipeline; the callers that joined
+    it get a copy of the result marked with `"coalesced": true` in its debug info. Calls with a
+    `session_id` are never shared, since each one advances its session's tracks. A caller with a
+    `deadline` stops waiting for a shared run when its own time is up, and a joiner that still has
+    time left when a shared run comes back incomplete runs the pipeline again for itself.
+    """
+    async def run():
+        results = await classify_images([image_bytes], clarifai_pat, gemini_api_key, sessions=[session_id], **kwargs)
+        return results[0]
+
+    if coalescer is None or session_id:
+        return await run()
+
+    deadline = kwargs.get("deadline")
+    try:
+        result, shared = await coalescer.run(
+            _frame_key(image_bytes, kwargs.get("debug", True)), run,
+            timeout=None if deadline is None else max(0.0, deadline - time.monotonic())
+        )
+    except asyncio.TimeoutError:
+        metrics.COALESCED.inc("frame")
+        return {
+            "trash_items": [],
+            "debug_info": {"confidence_threshold": CONFIDENCE_THRESHOLD, "clarifai_detections": [], "final_classifications": [], "coalesced": True, "deadline_hit": "coalesced"},
+            "incomplete": True
+        }
+    if not shared:
+        return result
+    if result.get("incomplete") and (deadline is None or time.monotonic() < deadline):
+        # The shared run ran out of its starter's time budget, but this caller still has time
+        # (or none was set), so it gets a run of its own.
+        return await run()
+    metrics.COALESCED.inc("frame")
+    result = copy.deepcopy(result)
+    if "debug_info" in result:
+        result["debug_info"]["coalesced"] = True
+    return result
 
 # --- Old: Gemini Classifier (Commented Out) ---
 # import google.generativeai as genai
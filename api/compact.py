@@ -0,0 +1,63 @@
+import json
+import struct
+
+# Compact encodings of a classification result for clients with little memory, such as the
+# ESP32. Only each item's category and box are kept; boxes are quantized to integers on a
+# 0..BOX_SCALE grid (relative to the image, like the full response's floats).
+BOX_SCALE = 1000
+
+JSON_MEDIA_TYPE = "application/vnd.auro.compact+json"
+BINARY_MEDIA_TYPE = "application/vnd.auro.compact"
+
+# Category codes of the binary format. New categories may only be appended.
+CATEGORY_CODES = ("paper", "plastic", "glass", "metal", "e-waste", "organic", "other")
+
+# Binary layout, little-endian: a header of version, flags (bit 0 = incomplete) and item count,
+# then per item the category code, left, top, right, bottom, and the track ID (0 if none).
+BINARY_VERSION = 1
+_HEADER = struct.Struct("<BBB")
+_ITEM = struct.Struct("<BHHHHH")
+
+
+def choose_format(format: str = None, accept: str = None) -> str:
+    """
+    Returns "compact", "binary" or "full" from the `format` query parameter, or failing that from
+    the Accept header.
+    """
+    if format:
+        format = format.lower()
+        return format if format in ("compact", "binary") else "full"
+    accept = (accept or "").lower()
+    if JSON_MEDIA_TYPE in accept:
+        return "compact"
+    if BINARY_MEDIA_TYPE in accept:
+        return "binary"
+    return "full"
+
+
+def _quantize(box) -> list:
+    return [min(BOX_SCALE, max(0, round(value * BOX_SCALE))) for value in box]
+
+
+def encode_json(result: dict) -> bytes:
+    """
+    `{"items": [[category, left, top, right, bottom(, track_id)], ...], "incomplete": bool}`,
+    without whitespace.
+    """
+    items = []
+    for item in result.get("trash_items", []):
+        entry = [item["category"], *_quantize(item["bounding_box"])]
+        if item.get("track_id") is not None:
+            entry.append(item["track_id"])
+        items.append(entry)
+    return json.dumps({"items": items, "incomplete": result.get("incomplete", False)}, separators=(",", ":")).encode()
+
+
+def encode_binary(result: dict) -> bytes:
+    items = result.get("trash_items", [])[:255]
+    parts = [_HEADER.pack(BINARY_VERSION, 1 if result.get("incomplete") else 0, len(items))]
+    for item in items:
+        category = item["category"]
+        code = CATEGORY_CODES.index(category) if category in CATEGORY_CODES else CATEGORY_CODES.index("other")
+        parts.append(_ITEM.pack(code, *_quantize(item["bounding_box"]), (item.get("track_id") or 0) & 0xFFFF))
+    return b"".join(parts)
@@ -0,0 +1,182 @@
+import os
+import math
+import time
+import uuid
+import sqlite3
+import asyncio
+import tempfile
+
+from . import metrics
+from .storage import SQLiteStore
+
+# Asynchronous classification jobs. Uploads wait in a bounded queue and a fixed number of
+# workers take them through the pipeline; clients poll for the result instead of holding a
+# connection open for the whole classification.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "32"))
+# How long finished jobs can be fetched, and the longest a single poll may wait for one.
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", "300"))
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", "30"))
+# SQLite file through which all workers on the machine can answer polls for each other's jobs.
+# Set it to an empty string if there is only one worker.
+JOB_STATE_PATH = os.getenv("JOB_STATE_PATH", os.path.join(tempfile.gettempdir(), "auro-jobs.sqlite"))
+
+FINISHED = ("done", "failed")
+
+
+class QueueFull(Exception):
+    """
+    Raised by `JobQueue.submit` when no more jobs can be accepted. `retry_after` is a rough
+    estimate, in whole seconds, of when there will be room again.
+    """
+    def __init__(self, retry_after: int):
+        super().__init__("The job queue is full.")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """
+    A bounded queue of classification jobs served by `workers` concurrent tasks.
+
+    A job is a coroutine function taking no arguments; whatever it returns becomes the job's
+    result, and an exception marks the job as failed. Jobs are tracked in this process and, with
+    `path`, mirrored to a SQLite file so that any worker can report on any job.
+    """
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_SIZE, ttl_seconds: float = JOB_RESULT_TTL_SECONDS, path: str = JOB_STATE_PATH):
+        self.workers = max(1, workers)
+        self.max_queued = max(1, max_queued)
+        self.ttl_seconds = ttl_seconds
+        self.running = 0
+        self._store = SQLiteStore(path, "jobs") if path else None
+        # Writes go through one lock in the order they were made, so a slow write of an older
+        # state can't land after a newer one.
+        self._store_lock = asyncio.Lock()
+        self._queue = None
+        self._tasks = []
+        self._jobs = {}
+        self._events = {}
+        # Moving average of how long a job takes to run, for Retry-After estimates.
+        self._service_seconds = 1.0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def retry_after(self) -> int:
+        backlog = (self.depth() + self.running) / self.workers
+        return max(1, min(60, math.ceil(backlog * self._service_seconds)))
+
+    async def _save(self, job: dict):
+        if self._store is None:
+            return
+        now = time.time()
+        # A copy, since the job keeps changing while the write runs in a thread.
+        snapshot = dict(job)
+        async with self._store_lock:
+            try:
+                await asyncio.to_thread(self._store.set, job["job_id"], snapshot, now + self.ttl_seconds, now, 10000)
+            except sqlite3.Error as e:
+                print(f"Error writing job state: {e}")
+
+    def _forget_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job["status"] in FINISHED and job["finished_at"] < cutoff:
+                del self._jobs[job_id]
+                self._events.pop(job_id, None)
+
+    async def submit(self, work) -> dict:
+        """
+        Queues `work` and returns the new job. Raises QueueFull if the queue is at capacity.
+        """
+        if self._queue is None:
+            raise RuntimeError("JobQueue.start() has not been called.")
+        self._forget_expired()
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "wait_seconds": None,
+            "result": None,
+            "error": None,
+        }
+        try:
+            self._queue.put_nowait((job, work, time.monotonic()))
+        except asyncio.QueueFull:
+            metrics.JOBS.inc("rejected")
+            raise QueueFull(self.retry_after())
+        self._jobs[job["job_id"]] = job
+        self._events[job["job_id"]] = asyncio.Event()
+        await self._save(job)
+        return job
+
+    async def _work(self):
+        while True:
+            job, work, queued_at = await self._queue.get()
+            started = time.monotonic()
+            self.running += 1
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            job["wait_seconds"] = round(started - queued_at, 3)
+            metrics.JOB_WAIT_SECONDS.observe(started - queued_at)
+            await self._save(job)
+            try:
+                job["result"] = await work()
+                job["status"] = "done"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error during classification job {job['job_id']}: {e}")
+                job["error"] = str(e)
+                job["status"] = "failed"
+            finally:
+                self.running -= 1
+                self._queue.task_done()
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * (time.monotonic() - started)
+            job["finished_at"] = time.time()
+            metrics.JOBS.inc(job["status"])
+            self._events[job["job_id"]].set()
+            await self._save(job)
+
+    async def _lookup(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is not None or self._store is None:
+            return job
+        try:
+            stored = await asyncio.to_thread(self._store.get, job_id, time.time())
+        except sqlite3.Error as e:
+            print(f"Error reading job state: {e}")
+            return None
+        return stored[0] if stored else None
+
+    async def get(self, job_id: str, wait: float = 0.0):
+        """
+        Returns the job, waiting up to `wait` seconds for it to finish first. Returns None if
+        no such job is known (or it has expired).
+        """
+        deadline = time.monotonic() + max(0.0, min(wait, JOB_MAX_WAIT_SECONDS))
+        while True:
+            job = await self._lookup(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in FINISHED or remaining <= 0:
+                return job
+            event = self._events.get(job_id)
+            if event is not None:
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # Another worker's job: watch the shared file.
+                await asyncio.sleep(min(0.25, remaining))
@@ -0,0 +1,205 @@
+import os
+import time
+import asyncio
+import hashlib
+import sqlite3
+import tempfile
+import threading
+
+from google.api_core import exceptions as google_exceptions
+
+from .storage import SQLiteConnection
+
+# Per-key Gemini limits. Each key gets a token bucket refilled at GEMINI_KEY_RPM requests per
+# minute (holding at most GEMINI_KEY_BURST tokens) and may make GEMINI_KEY_RPD requests per day.
+GEMINI_KEY_RPM = float(os.getenv("GEMINI_KEY_RPM", "15"))
+GEMINI_KEY_BURST = float(os.getenv("GEMINI_KEY_BURST", "5"))
+GEMINI_KEY_RPD = int(os.getenv("GEMINI_KEY_RPD", "1500"))
+# How long a key rests after Gemini throttles it (429) or after repeated errors. Both double
+# with every further failure in a row, up to GEMINI_KEY_MAX_COOLDOWN_SECONDS.
+GEMINI_KEY_THROTTLE_COOLDOWN_SECONDS = float(os.getenv("GEMINI_KEY_THROTTLE_COOLDOWN_SECONDS", "30"))
+GEMINI_KEY_ERROR_COOLDOWN_SECONDS = float(os.getenv("GEMINI_KEY_ERROR_COOLDOWN_SECONDS", "5"))
+GEMINI_KEY_MAX_COOLDOWN_SECONDS = float(os.getenv("GEMINI_KEY_MAX_COOLDOWN_SECONDS", "600"))
+# How long a Gemini call may wait for a key to become available before giving up.
+GEMINI_KEY_WAIT_SECONDS = float(os.getenv("GEMINI_KEY_WAIT_SECONDS", "10"))
+# SQLite file holding the key state, so every worker on the machine shares one view of each
+# key's budget. Set it to an empty string to keep the state in this process only.
+GEMINI_KEY_STATE_PATH = os.getenv("GEMINI_KEY_STATE_PATH", os.path.join(tempfile.gettempdir(), "auro-gemini-keys.sqlite"))
+
+THROTTLE_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+
+
+def _key_id(api_key: str) -> str:
+    # Raw keys never touch the disk; rows are identified by a digest.
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+class GeminiKeyScheduler:
+    """
+    Hands out Gemini API keys one call at a time, based on how much budget each key has left.
+
+    Every call to `acquire` takes one token from the chosen key's bucket and counts against its
+    daily quota; the key with the most tokens left wins. Keys that are throttled or failing are
+    put on a cooldown and skipped until it ends. The state is kept in a SQLite file so that all
+    gunicorn workers draw from the same budget.
+    """
+    def __init__(self, api_keys, rpm: float = GEMINI_KEY_RPM, burst: float = GEMINI_KEY_BURST, rpd: int = GEMINI_KEY_RPD, state_path: str = GEMINI_KEY_STATE_PATH):
+        self.api_keys = {_key_id(api_key): api_key for api_key in api_keys}
+        self.rate = rpm / 60.0
+        self.burst = max(1.0, burst)
+        self.rpd = rpd
+        self.state_path = state_path or ":memory:"
+        self._lock = threading.Lock()
+        self._connection = SQLiteConnection(self.state_path, self._create_tables).get
+
+    def _create_tables(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS gemini_keys ("
+            "id TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, "
+            "cooldown_until REAL NOT NULL DEFAULT 0, failures INTEGER NOT NULL DEFAULT 0, "
+            "day TEXT NOT NULL DEFAULT '', day_count INTEGER NOT NULL DEFAULT 0, "
+            "total INTEGER NOT NULL DEFAULT 0, throttled INTEGER NOT NULL DEFAULT 0, errors INTEGER NOT NULL DEFAULT 0)"
+        )
+        now = time.time()
+        conn.executemany(
+            "INSERT OR IGNORE INTO gemini_keys (id, tokens, updated) VALUES (?, ?, ?)",
+            [(key_id, self.burst, now) for key_id in self.api_keys]
+        )
+
+    def _try_acquire(self, exclude=()):
+        """
+        Takes a token from the best available key. Returns (api_key, 0) on success, or
+        (None, seconds until a key might be available).
+        """
+        now = time.time()
+        today = time.strftime("%Y-%m-%d", time.gmtime(now))
+        candidates = [key_id for key_id, api_key in self.api_keys.items() if api_key not in exclude]
+        if not candidates:
+            return None, GEMINI_KEY_WAIT_SECONDS
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    f"SELECT id, tokens, updated, cooldown_until, day, day_count FROM gemini_keys WHERE id IN ({','.join('?' * len(candidates))})",
+                    candidates
+                ).fetchall()
+
+                best = None
+                wait = float("inf")
+                for key_id, tokens, updated, cooldown_until, day, day_count in rows:
+                    tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+                    if day != today:
+                        day_count = 0
+                    if self.rpd and day_count >= self.rpd:
+                        continue
+                    if cooldown_until > now:
+                        wait = min(wait, cooldown_until - now)
+                        continue
+                    if tokens < 1.0:
+                        wait = min(wait, (1.0 - tokens) / self.rate if self.rate > 0 else GEMINI_KEY_WAIT_SECONDS)
+                        continue
+                    if best is None or tokens > best[1]:
+                        best = (key_id, tokens, day_count)
+
+                if best is None:
+                    conn.execute("COMMIT")
+                    return None, wait
+
+                key_id, tokens, day_count = best
+                conn.execute(
+                    "UPDATE gemini_keys SET tokens = ?, updated = ?, day = ?, day_count = ?, total = total + 1 WHERE id = ?",
+                    (tokens - 1.0, now, today, day_count + 1, key_id)
+                )
+                conn.execute("COMMIT")
+                return self.api_keys[key_id], 0.0
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def acquire(self, timeout: float = GEMINI_KEY_WAIT_SECONDS, exclude=()) -> str:
+        """
+        Waits up to `timeout` seconds for a key with budget left and returns it. Keys in `exclude`
+        are never returned. Raises TimeoutError if no key became available in time.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            api_key, wait = await asyncio.to_thread(self._try_acquire, exclude)
+            if api_key is not None:
+                return api_key
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No Gemini API key is available right now (all are rate limited or cooling down).")
+            await asyncio.sleep(min(wait, remaining, 1.0))
+
+    def _update(self, sql: str, params):
+        with self._lock:
+            self._connection().execute(sql, params)
+
+    async def report_success(self, api_key: str):
+        await asyncio.to_thread(self._update, "UPDATE gemini_keys SET failures = 0 WHERE id = ?", (_key_id(api_key),))
+
+    async def report_failure(self, api_key: str, error: Exception):
+        """
+        Puts the key on cooldown. Throttling (429) rests the key for longer than other errors, and
+        both cooldowns double with each consecutive failure.
+        """
+        throttled = isinstance(error, THROTTLE_ERRORS)
+        base = GEMINI_KEY_THROTTLE_COOLDOWN_SECONDS if throttled else GEMINI_KEY_ERROR_COOLDOWN_SECONDS
+        key_id = _key_id(api_key)
+
+        def update():
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute("SELECT failures FROM gemini_keys WHERE id = ?", (key_id,)).fetchone()
+                failures = (row[0] if row else 0) + 1
+                # A single stray error doesn't bench a key; throttling always does.
+                cooldown = min(GEMINI_KEY_MAX_COOLDOWN_SECONDS, base * 2 ** (failures - 1)) if throttled or failures > 1 else 0.0
+                conn.execute(
+                    "UPDATE gemini_keys SET failures = ?, cooldown_until = ?, throttled = throttled + ?, errors = errors + ? WHERE id = ?",
+                    (failures, time.time() + cooldown, int(throttled), int(not throttled), key_id)
+                )
+
+        await asyncio.to_thread(update)
+
+    def stats(self) -> dict:
+        """
+        Returns the current state of every key, labelled by position (key_1, key_2, ...).
+        """
+        with self._lock:
+            rows = dict((row[0], row[1:]) for row in self._connection().execute(
+                "SELECT id, tokens, updated, cooldown_until, day_count, total, throttled, errors FROM gemini_keys"
+            ))
+        now = time.time()
+        stats = {}
+        for position, key_id in enumerate(self.api_keys, start=1):
+            tokens, updated, cooldown_until, day_count, total, throttled, errors = rows[key_id]
+            stats[f"key_{position}"] = {
+                "tokens": round(min(self.burst, tokens + max(0.0, now - updated) * self.rate), 2),
+                "cooldown_seconds": round(max(0.0, cooldown_until - now), 1),
+                "requests_today": day_count,
+                "requests_total": total,
+                "throttled": throttled,
+                "errors": errors,
+            }
+        return stats
+
+
+class SingleKey:
+    """
+    Stands in for a GeminiKeyScheduler when the caller has exactly one key and no budget to track.
+    """
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+
+    async def acquire(self, timeout: float = GEMINI_KEY_WAIT_SECONDS, exclude=()) -> str:
+        if self.api_key in exclude:
+            raise TimeoutError("No other Gemini API key is available.")
+        return self.api_key
+
+    async def report_success(self, api_key: str):
+        pass
+
+    async def report_failure(self, api_key: str, error: Exception):
+        pass
@@ -0,0 +1,193 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+
+import numpy as np
+from PIL import Image
+
+from .storage import SQLiteConnection
+
+# A small k-nearest-neighbour material classifier that learns from Gemini's own answers. Every
+# crop Gemini classifies is stored as a compact color/texture feature vector with its category;
+# once enough examples exist, crops whose nearest neighbours agree strongly are classified locally
+# and never reach Gemini.
+LOCAL_MODEL_ENABLED = os.getenv("LOCAL_MODEL_ENABLED", "false").lower() in ("1", "true", "yes")
+# Where examples are kept. The file is shared by all workers and survives restarts, so point it
+# at persistent storage. Set it to an empty string to keep examples in this process only.
+LOCAL_MODEL_PATH = os.getenv("LOCAL_MODEL_PATH", os.path.join(tempfile.gettempdir(), "auro-local-model.sqlite"))
+# Neighbours consulted per crop, and the share of them (weighted by similarity) that must agree
+# before Gemini is skipped. A confidence above 1 keeps collecting examples without using them.
+LOCAL_MODEL_K = int(os.getenv("LOCAL_MODEL_K", "7"))
+LOCAL_MODEL_CONFIDENCE = float(os.getenv("LOCAL_MODEL_CONFIDENCE", "0.85"))
+# Neighbours less similar than this (cosine similarity of the features) don't count as votes.
+LOCAL_MODEL_MIN_SIMILARITY = float(os.getenv("LOCAL_MODEL_MIN_SIMILARITY", "0.90"))
+# No local decisions until this many examples have been collected.
+LOCAL_MODEL_MIN_SAMPLES = int(os.getenv("LOCAL_MODEL_MIN_SAMPLES", "500"))
+# Most recent examples held in memory for matching.
+LOCAL_MODEL_MAX_SAMPLES = int(os.getenv("LOCAL_MODEL_MAX_SAMPLES", "50000"))
+# How often new examples (from this and other workers) are pulled into the in-memory model.
+LOCAL_MODEL_REFRESH_SECONDS = float(os.getenv("LOCAL_MODEL_REFRESH_SECONDS", "30"))
+
+FEATURE_SIDE = 64
+HUE_BINS, SATURATION_BINS, VALUE_BINS = 8, 4, 4
+ORIENTATION_BINS, MAGNITUDE_BINS = 8, 8
+FEATURE_SIZE = HUE_BINS * SATURATION_BINS * VALUE_BINS + ORIENTATION_BINS + MAGNITUDE_BINS
+
+
+def _unit(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def crop_features(image: Image.Image) -> np.ndarray:
+    """
+    Describes a crop by its HSV color histogram and a histogram of edge orientations and
+    strengths, computed on a small thumbnail. Returns a unit-length float32 vector, so the dot
+    product of two vectors is their cosine similarity.
+    """
+    thumbnail = image.convert("RGB").resize((FEATURE_SIDE, FEATURE_SIDE), Image.BILINEAR)
+
+    hsv = np.asarray(thumbnail.convert("HSV"), dtype=np.uint16)
+    hue = hsv[..., 0] * HUE_BINS // 256
+    saturation = hsv[..., 1] * SATURATION_BINS // 256
+    value = hsv[..., 2] * VALUE_BINS // 256
+    color = np.bincount(
+        ((hue * SATURATION_BINS + saturation) * VALUE_BINS + value).ravel(),
+        minlength=HUE_BINS * SATURATION_BINS * VALUE_BINS
+    ).astype(np.float32)
+
+    gray = np.asarray(thumbnail.convert("L"), dtype=np.float32) / 255.0
+    dx = gray[1:-1, 2:] - gray[1:-1, :-2]
+    dy = gray[2:, 1:-1] - gray[:-2, 1:-1]
+    magnitude = np.hypot(dx, dy).ravel()
+    # Orientation modulo pi: an edge looks the same from either side.
+    orientation = ((np.arctan2(dy, dx).ravel() % np.pi) / np.pi * ORIENTATION_BINS).astype(np.int64) % ORIENTATION_BINS
+    edges = np.bincount(orientation, weights=magnitude, minlength=ORIENTATION_BINS).astype(np.float32)
+    strength = np.histogram(magnitude, bins=MAGNITUDE_BINS, range=(0.0, 1.0))[0].astype(np.float32)
+
+    return _unit(np.concatenate([_unit(color), 0.5 * _unit(edges), 0.5 * _unit(strength)])).astype(np.float32)
+
+
+class LocalMaterialModel:
+    """
+    Collects (crop features, category) examples from Gemini and predicts categories for new
+    crops from their nearest stored neighbours.
+
+    Examples are written to a SQLite file so every worker learns from all of them and they
+    survive restarts. Each process keeps the most recent LOCAL_MODEL_MAX_SAMPLES in a NumPy
+    matrix, loaded once at startup and then topped up with only the new rows every
+    LOCAL_MODEL_REFRESH_SECONDS.
+    """
+    def __init__(self, path: str = LOCAL_MODEL_PATH, k: int = LOCAL_MODEL_K, confidence: float = LOCAL_MODEL_CONFIDENCE, min_similarity: float = LOCAL_MODEL_MIN_SIMILARITY, min_samples: int = LOCAL_MODEL_MIN_SAMPLES, max_samples: int = LOCAL_MODEL_MAX_SAMPLES, refresh_seconds: float = LOCAL_MODEL_REFRESH_SECONDS):
+        self.path = path or ":memory:"
+        self.k = max(1, k)
+        self.confidence = confidence
+        self.min_similarity = min_similarity
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.refresh_seconds = refresh_seconds
+        self.categories = []
+        self._category_index = {}
+        self._features = np.empty((0, FEATURE_SIZE), dtype=np.float32)
+        self._labels = np.empty(0, dtype=np.int16)
+        self._last_id = 0
+        self._refreshed = 0.0
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._connection = SQLiteConnection(self.path, self._create_table).get
+
+    def _create_table(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS material_examples "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, features BLOB NOT NULL, category TEXT NOT NULL, created REAL NOT NULL)"
+        )
+
+    def _label(self, category: str) -> int:
+        index = self._category_index.get(category)
+        if index is None:
+            index = self._category_index[category] = len(self.categories)
+            self.categories.append(category)
+        return index
+
+    def refresh(self, force: bool = False) -> int:
+        """
+        Pulls examples added since the last refresh into memory and returns how many there were.
+        The first call loads the newest `max_samples` examples in one query.
+        """
+        now = time.monotonic()
+        if not force and now - self._refreshed < self.refresh_seconds:
+            return 0
+        self._refreshed = now
+
+        # Held throughout, so two threads refreshing at once can't load the same rows twice.
+        with self._db_lock:
+            conn = self._connection()
+            if self._last_id == 0:
+                rows = conn.execute(
+                    "SELECT id, features, category FROM (SELECT * FROM material_examples ORDER BY id DESC LIMIT ?) ORDER BY id",
+                    (self.max_samples,)
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT id, features, category FROM material_examples WHERE id > ? ORDER BY id",
+                    (self._last_id,)
+                ).fetchall()
+            if not rows:
+                return 0
+
+            features = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), FEATURE_SIZE)
+            with self._lock:
+                labels = np.array([self._label(row[2]) for row in rows], dtype=np.int16)
+                self._features = np.concatenate([self._features, features])[-self.max_samples:]
+                self._labels = np.concatenate([self._labels, labels])[-self.max_samples:]
+                self._last_id = rows[-1][0]
+            return len(rows)
+
+    def add(self, features, categories):
+        """
+        Stores labelled examples (one feature row per category). They are used for predictions
+        after the next refresh.
+        """
+        now = time.time()
+        with self._db_lock:
+            self._connection().executemany(
+                "INSERT INTO material_examples (features, category, created) VALUES (?, ?, ?)",
+                [(np.asarray(row, dtype=np.float32).tobytes(), category, now) for row, category in zip(features, categories)]
+            )
+
+    def predict(self, features: np.ndarray):
+        """
+        Returns one (category, confidence) pair per row of `features`, or (None, 0.0) for every
+        row while fewer than `min_samples` examples are loaded. Confidence is the
+        similarity-weighted share of the k nearest examples that vote for the category, counting
+        only neighbours at least `min_similarity` alike.
+        """
+        self.refresh()
+        with self._lock:
+            stored, labels = self._features, self._labels
+            categories = list(self.categories)
+        if len(features) == 0 or len(stored) < max(self.min_samples, 1):
+            return [(None, 0.0)] * len(features)
+
+        k = min(self.k, len(stored))
+        similarities = np.asarray(features, dtype=np.float32) @ stored.T
+        nearest = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        weights = np.take_along_axis(similarities, nearest, axis=1)
+        weights = np.where(weights >= self.min_similarity, weights, 0.0)
+
+        predictions = []
+        for row_weights, row_nearest in zip(weights, nearest):
+            votes = np.bincount(labels[row_nearest], weights=row_weights, minlength=len(categories))
+            best = int(np.argmax(votes))
+            confidence = float(votes[best]) / self.k
+            predictions.append((categories[best], round(confidence, 3)) if confidence > 0 else (None, 0.0))
+        return predictions
+
+    def is_confident(self, confidence: float) -> bool:
+        return confidence >= self.confidence
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"samples": len(self._labels), "categories": len(self.categories), "ready": len(self._labels) >= self.min_samples}
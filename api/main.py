@@ -1,16 +1,24 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect, Response, Header, Query
 from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
-from PIL import Image
-import io
+from typing import List, Dict, Any, Optional, Union
 import os
 from dotenv import load_dotenv
 # import google.generativeai as genai (No longer needed here)
 from contextlib import asynccontextmanager
 from . import classifier
+from . import metrics
+from . import compact
+from .cache import ClassifierCache, SingleFlight, CACHE_ENABLED
+from .key_scheduler import GeminiKeyScheduler
+from .local_model import LocalMaterialModel, LOCAL_MODEL_ENABLED
+from .tracking import ObjectTracker
+from .jobs import JobQueue, QueueFull
+from .replay import BackendCorpus, RecordingDetector, ReplayDetector, BACKEND_MODE, REPLAY_CORPUS_PATH
 import uvicorn
 import time
+import asyncio
+import uuid
 
 # Load environment variables at the very top to ensure they are available for all modules.
 load_dotenv()
@@ -18,6 +26,37 @@ load_dotenv()
 # Load all credentials on startup
 CLARIFAI_API_KEY = os.getenv("CLARIFAI_API_KEY")# CLARIFAI_USER_ID = os.getenv("CLARIFAI_USER_ID") # No longer needed
 # CLARIFAI_APP_ID = os.getenv("CLARIFAI_APP_ID")   # No longer needed
+if BACKEND_MODE == "replay":
+    # Nothing is sent to the backends when replaying, so no real credentials are needed.
+    CLARIFAI_API_KEY = CLARIFAI_API_KEY or "replay"
+
+# Import the backend SDKs as soon as the app is loaded instead of on first use. Set it together
+# with gunicorn --preload, so the master process imports them once and its workers share them.
+PRELOAD_BACKENDS = os.getenv("PRELOAD_BACKENDS", "false").lower() in ("1", "true", "yes")
+if PRELOAD_BACKENDS:
+    classifier.import_backends()
+
+# How long each worker waits at startup for its Clarifai and Gemini connections to be ready
+# before it starts serving. 0 skips the warm-up; connections are then opened by the first requests.
+WARM_UP_TIMEOUT_SECONDS = float(os.getenv("WARM_UP_TIMEOUT_SECONDS", "5"))
+
+# Most images accepted by a single /classify/batch request.
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "16"))
+
+# Latency budget for requests that don't send their own (`budget_ms` query parameter or
+# `X-Latency-Budget-Ms` header). 0 means no budget. DEADLINE_MARGIN_MS of each budget is kept
+# back for building and sending the response.
+REQUEST_BUDGET_MS = int(os.getenv("REQUEST_BUDGET_MS", "0"))
+DEADLINE_MARGIN_MS = int(os.getenv("DEADLINE_MARGIN_MS", "50"))
+
+def _deadline(started: float, budget_ms: Optional[int]) -> Optional[float]:
+    """
+    Turns a latency budget into a `time.monotonic()` deadline for the classifier, or None.
+    """
+    budget_ms = budget_ms or REQUEST_BUDGET_MS
+    if budget_ms <= 0:
+        return None
+    return started + max(0, budget_ms - DEADLINE_MARGIN_MS) / 1000.0
 
 # --- Pydantic Models for Documentation ---
 # These models define the structure of the API response for the auto-generated docs.
@@ -25,11 +64,20 @@ CLARIFAI_API_KEY = os.getenv("CLARIFAI_API_KEY")# CLARIFAI_USER_ID = os.getenv("
 class TrashItem(BaseModel):
     category: str
     bounding_box: List[float]
+    track_id: Optional[int] = None
 
 class DebugInfo(BaseModel):
     confidence_threshold: float
     clarifai_detections: List[Dict[str, Any]]
-    final_classifications: List[Dict[str, Any]]
+    final_classifications: List[Union[Dict[str, Any], str]]
+    cache: Optional[Dict[str, Any]] = None
+    tiers: Optional[Dict[str, int]] = None
+    ingest: Optional[Dict[str, Any]] = None
+    gemini_payload_bytes: Optional[int] = None
+    tracking: Optional[Dict[str, Any]] = None
+    regions: Optional[Dict[str, Any]] = None
+    coalesced: Optional[bool] = None
+    deadline_hit: Optional[str] = None
 
 class ClassificationResponse(BaseModel):
     api_version: str
@@ -37,6 +85,29 @@ class ClassificationResponse(BaseModel):
     response_time: str
     trash_items: List[TrashItem]
     debug_info: DebugInfo
+    incomplete: bool = False
+
+class ImageResult(BaseModel):
+    filename: Optional[str] = None
+    trash_items: List[TrashItem] = []
+    debug_info: Optional[DebugInfo] = None
+    error: Optional[str] = None
+    incomplete: bool = False
+
+class BatchClassificationResponse(BaseModel):
+    api_version: str
+    model_used: str
+    response_time: str
+    results: List[ImageResult]
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    poll_url: Optional[str] = None
+    queue_depth: Optional[int] = None
+    wait_seconds: Optional[float] = None
+    result: Optional[ClassificationResponse] = None
+    error: Optional[str] = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -56,7 +127,19 @@ async def lifespan(app: FastAPI):
             break
             
     app.state.gemini_keys = gemini_keys
-    app.state.current_key_index = 0
+    # Keys are assigned per Gemini call, based on each key's remaining budget across all workers.
+    app.state.key_scheduler = GeminiKeyScheduler(gemini_keys)
+
+    # --- Record or replay the backend traffic ---
+    corpus = None
+    if BACKEND_MODE in ("record", "replay"):
+        corpus = BackendCorpus(REPLAY_CORPUS_PATH)
+        classifier.use_corpus(corpus, BACKEND_MODE)
+        print(f"Backend mode '{BACKEND_MODE}' with {len(corpus)} entries in {REPLAY_CORPUS_PATH}.")
+    if BACKEND_MODE == "replay":
+        # Replayed answers cost nothing, so the keys' rate limits don't apply.
+        app.state.gemini_keys = gemini_keys = gemini_keys or ["replay"]
+        app.state.key_scheduler = GeminiKeyScheduler(gemini_keys, rpm=1e6, burst=1e6, rpd=0, state_path="")
 
     # --- Log Status of All Credentials ---
     if not CLARIFAI_API_KEY:
@@ -69,16 +152,80 @@ async def lifespan(app: FastAPI):
     else:
         print(f"Successfully loaded {len(app.state.gemini_keys)} Gemini API keys.")
 
+    # --- Result cache (per process, optionally shared on disk) ---
+    app.state.cache = ClassifierCache() if CACHE_ENABLED else None
+
+    # --- Identical uploads in flight at the same time share one classification ---
+    app.state.inflight = SingleFlight()
+
+    # --- Per-session object tracks ---
+    app.state.tracker = ObjectTracker()
+
+    # --- Local material model, trained on Gemini's answers ---
+    app.state.local_model = None
+    if LOCAL_MODEL_ENABLED:
+        app.state.local_model = LocalMaterialModel()
+        loaded = await asyncio.to_thread(app.state.local_model.refresh, True)
+        print(f"Local material model loaded {loaded} examples.")
+
+    # --- Queue and workers for /jobs/classify ---
+    app.state.jobs = JobQueue()
+    app.state.jobs.start()
+
+    # --- Open the shared Clarifai connection and the Gemini clients ---
+    if BACKEND_MODE == "replay":
+        app.state.clarifai = ReplayDetector(corpus)
+    elif BACKEND_MODE == "record":
+        app.state.clarifai = RecordingDetector(classifier.ClarifaiDetector(), corpus)
+    else:
+        app.state.clarifai = classifier.ClarifaiDetector()
+    if WARM_UP_TIMEOUT_SECONDS > 0 and BACKEND_MODE != "replay":
+        started = time.monotonic()
+        clarifai_ready, gemini_ready = await asyncio.gather(
+            app.state.clarifai.warm_up(WARM_UP_TIMEOUT_SECONDS) if CLARIFAI_API_KEY else asyncio.sleep(0, True),
+            classifier.warm_up_gemini(gemini_keys, WARM_UP_TIMEOUT_SECONDS)
+        )
+        if not clarifai_ready:
+            print("Warning: Clarifai channel is not ready yet; it will keep connecting in the background.")
+        if gemini_ready < len(gemini_keys):
+            print(f"Warning: {len(gemini_keys) - gemini_ready} Gemini connections are not ready yet.")
+        print(f"Backends warmed up in {time.monotonic() - started:.2f}s.")
+
     yield
+    await app.state.jobs.stop()
+    await app.state.clarifai.close()
     print("Shutting down.")
 
 app = FastAPI(
     title="AURo API",
     description="AI-powered waste classification for the Autonomous Urban Recycler.",
-    version="1.7.4", # Allow HEAD requests for health checks
+    version="1.21.0", # Allow HEAD requests for health checks
     lifespan=lifespan
 )
 
+def _key_state(field: str) -> dict:
+    scheduler = getattr(app.state, "key_scheduler", None)
+    if scheduler is None:
+        return {}
+    return {(key,): state[field] for key, state in scheduler.stats().items()}
+
+# Per-key Gemini scheduler state, exported on /metrics.
+metrics.Gauge("auro_gemini_key_tokens", "Requests each Gemini key can make right now.", ("key",), lambda: _key_state("tokens"))
+metrics.Gauge("auro_gemini_key_cooldown_seconds", "Seconds until a cooling-down Gemini key is used again.", ("key",), lambda: _key_state("cooldown_seconds"))
+metrics.Gauge("auro_gemini_key_requests_today", "Requests made with each Gemini key today (UTC).", ("key",), lambda: _key_state("requests_today"))
+metrics.Gauge(
+    "auro_local_model_samples", "Examples the local material model currently matches against.", (),
+    lambda: {(): app.state.local_model.stats()["samples"]} if getattr(app.state, "local_model", None) else {}
+)
+metrics.Gauge(
+    "auro_job_queue_depth", "Classification jobs waiting for a worker.", (),
+    lambda: {(): app.state.jobs.depth()} if getattr(app.state, "jobs", None) else {}
+)
+metrics.Gauge(
+    "auro_jobs_running", "Classification jobs being processed right now.", (),
+    lambda: {(): app.state.jobs.running} if getattr(app.state, "jobs", None) else {}
+)
+
 @app.api_route("/", methods=["GET", "HEAD"], include_in_schema=False) # Hide from docs
 async def root():
     return { "message": "Welcome to the AURo API!", "version": app.version, "docs_url": "/docs" }
@@ -91,8 +238,23 @@ async def health_check():
     """
     return "OK"
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics_endpoint():
+    """
+    Request, stage and backend metrics of this worker in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/classify/", response_model=ClassificationResponse)
-async def classify_image_endpoint(file: UploadFile = File(...)):
+async def classify_image_endpoint(
+    response: Response,
+    file: UploadFile = File(...),
+    session_id: Optional[str] = None,
+    budget_ms: Optional[int] = None,
+    response_format: Optional[str] = Query(None, alias="format"),
+    x_latency_budget_ms: Optional[int] = Header(None),
+    accept: Optional[str] = Header(None)
+):
     """
     Receives an image file, analyzes it to find and classify waste, and returns the results.
 
@@ -101,33 +263,61 @@ async def classify_image_endpoint(file: UploadFile = File(...)):
     2.  **Analysis:** For each high-confidence detection, it crops the object and uses the Gemini Vision model to perform a detailed material analysis.
 
     The response includes a list of classified trash items and detailed debug information about the process.
+
+    Pass the same `session_id` query parameter with every frame of a scene (e.g. one per robot) to have objects
+    tracked across frames: each item gets a stable `track_id`, and objects that haven't moved reuse their earlier
+    category instead of being analyzed again.
+
+    To bound the response time, send a latency budget in milliseconds as the `budget_ms` query parameter or the
+    `X-Latency-Budget-Ms` header. Objects that couldn't be classified in time are left out and the response is
+    marked `"incomplete": true` instead of failing.
+
+    Per-stage timings are reported in the `Server-Timing` header.
+
+    Clients with little memory can ask for a compact response with `format=compact` (minimal JSON) or `format=binary`
+    (a fixed binary layout), or the matching `Accept` header (`application/vnd.auro.compact+json` or
+    `application/vnd.auro.compact`). These contain only each item's category and box, quantized to 0..1000, and no
+    debug information is collected for them. See `api/compact.py` for the exact layouts.
     """
+    deadline = _deadline(time.monotonic(), budget_ms or x_latency_budget_ms)
+    response_format = compact.choose_format(response_format, accept)
     if not CLARIFAI_API_KEY or not app.state.gemini_keys:
         raise HTTPException(status_code=500, detail="API credentials are not fully configured on the server.")
 
     try:
-        # Get the next Gemini API key for this request
-        key_index = app.state.current_key_index
-        gemini_key = app.state.gemini_keys[key_index]
-        
-        # Rotate key index for the NEXT request
-        app.state.current_key_index = (key_index + 1) % len(app.state.gemini_keys)
-        
-        contents = await file.read()
-        pil_image = Image.open(io.BytesIO(contents))
-        
-        start_time = time.time()
-        result = classifier.classify_image(
-            pil_image, 
-            clarifai_pat=CLARIFAI_API_KEY, 
-            gemini_api_key=gemini_key
-        )
-        end_time = time.time()
-        response_time = end_time - start_time
+        with metrics.track_request("classify") as request_metrics:
+            with metrics.stage("read"):
+                contents = await file.read()
+
+            start_time = time.time()
+            result = await classifier.classify_image(
+                contents,
+                clarifai_pat=CLARIFAI_API_KEY,
+                session_id=session_id,
+                key_scheduler=app.state.key_scheduler,
+                detector=app.state.clarifai,
+                cache=app.state.cache,
+                local_model=app.state.local_model,
+                tracker=app.state.tracker,
+                coalescer=app.state.inflight,
+                deadline=deadline,
+                debug=response_format == "full"
+            )
+            end_time = time.time()
+            response_time = end_time - start_time
+            if "error" in result:
+                request_metrics.outcome = "error"
+        response.headers["Server-Timing"] = request_metrics.server_timing()
 
         if "error" in result:
             raise HTTPException(status_code=500, detail=f"AI model error: {result['error']}")
 
+        # Compact responses are returned as they are, skipping response model validation.
+        if response_format == "compact":
+            return Response(compact.encode_json(result), media_type=compact.JSON_MEDIA_TYPE, headers={"Server-Timing": response.headers["Server-Timing"]})
+        if response_format == "binary":
+            return Response(compact.encode_binary(result), media_type=compact.BINARY_MEDIA_TYPE, headers={"Server-Timing": response.headers["Server-Timing"]})
+
         # The classifier now returns both trash_items and debug_info
         trash_items = result.get("trash_items", [])
         debug_info = result.get("debug_info", {})
@@ -137,12 +327,239 @@ async def classify_image_endpoint(file: UploadFile = File(...)):
             "model_used": "clarifai-detection + gemini-vision",
             "response_time": f"{response_time:.2f}s",
             "trash_items": trash_items,
-            "debug_info": debug_info
+            "debug_info": debug_info,
+            "incomplete": result.get("incomplete", False)
         }
 
     except Exception as e:
         print(f"Error during classification: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
+@app.post("/classify/batch", response_model=BatchClassificationResponse)
+async def classify_batch_endpoint(
+    response: Response,
+    files: List[UploadFile] = File(...),
+    budget_ms: Optional[int] = None,
+    x_latency_budget_ms: Optional[int] = Header(None)
+):
+    """
+    Receives several image files (e.g. one per camera of a sorting station) and classifies them together.
+
+    All images are sent to the Clarifai detection model in a single request, and the crops from every image share
+    one Gemini analysis stage. Results are returned per image, in upload order. An image that can't be processed
+    gets an `error` instead of failing the whole batch. A latency budget can be given as for `/classify/`.
+    """
+    deadline = _deadline(time.monotonic(), budget_ms or x_latency_budget_ms)
+    if not CLARIFAI_API_KEY or not app.state.gemini_keys:
+        raise HTTPException(status_code=500, detail="API credentials are not fully configured on the server.")
+    if len(files) > MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Too many images; at most {MAX_BATCH_IMAGES} are accepted per batch.")
+
+    try:
+        with metrics.track_request("classify_batch") as request_metrics:
+            with metrics.stage("read"):
+                contents = [await file.read() for file in files]
+
+            start_time = time.time()
+            results = await classifier.classify_images(
+                contents,
+                clarifai_pat=CLARIFAI_API_KEY,
+                key_scheduler=app.state.key_scheduler,
+                detector=app.state.clarifai,
+                cache=app.state.cache,
+                local_model=app.state.local_model,
+                deadline=deadline
+            )
+            end_time = time.time()
+            response_time = end_time - start_time
+            if any("error" in result for result in results):
+                request_metrics.outcome = "error"
+        response.headers["Server-Timing"] = request_metrics.server_timing()
+
+        return {
+            "api_version": app.version,
+            "model_used": "clarifai-detection + gemini-vision",
+            "response_time": f"{response_time:.2f}s",
+            "results": [{"filename": file.filename, **result} for file, result in zip(files, results)]
+        }
+
+    except Exception as e:
+        print(f"Error during batch classification: {e}")
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
+@app.post("/jobs/classify", response_model=JobResponse, status_code=202)
+async def submit_job_endpoint(
+    file: UploadFile = File(...),
+    session_id: Optional[str] = None,
+    budget_ms: Optional[int] = None,
+    x_latency_budget_ms: Optional[int] = Header(None)
+):
+    """
+    Queues an image for classification and returns a job ID right away, for clients whose connection can't stay
+    open for a whole classification.
+
+    Fetch the result from `GET /jobs/{job_id}`. Jobs are processed by a fixed number of workers in the order they
+    were submitted; when the queue is full the request is rejected with 429 and a `Retry-After` header. A latency
+    budget can be given as for `/classify/`, counted from when a worker takes the job up.
+    """
+    if not CLARIFAI_API_KEY or not app.state.gemini_keys:
+        raise HTTPException(status_code=500, detail="API credentials are not fully configured on the server.")
+
+    contents = await file.read()
+    budget_ms = budget_ms or x_latency_budget_ms
+
+    async def work():
+        with metrics.track_request("job") as request_metrics:
+            start_time = time.time()
+            result = await classifier.classify_image(
+                contents,
+                clarifai_pat=CLARIFAI_API_KEY,
+                session_id=session_id,
+                key_scheduler=app.state.key_scheduler,
+                detector=app.state.clarifai,
+                cache=app.state.cache,
+                local_model=app.state.local_model,
+                tracker=app.state.tracker,
+                coalescer=app.state.inflight,
+                deadline=_deadline(time.monotonic(), budget_ms)
+            )
+            response_time = time.time() - start_time
+            if "error" in result:
+                request_metrics.outcome = "error"
+                raise RuntimeError(f"AI model error: {result['error']}")
+        return {
+            "api_version": app.version,
+            "model_used": "clarifai-detection + gemini-vision",
+            "response_time": f"{response_time:.2f}s",
+            "trash_items": result.get("trash_items", []),
+            "debug_info": result.get("debug_info", {}),
+            "incomplete": result.get("incomplete", False)
+        }
+
+    try:
+        job = await app.state.jobs.submit(work)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "poll_url": f"/jobs/{job['job_id']}",
+        "queue_depth": app.state.jobs.depth()
+    }
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job_endpoint(job_id: str, wait: float = 0.0):
+    """
+    Returns the status of a classification job: `queued`, `running`, `done` (with `result`, shaped like a
+    `/classify/` response) or `failed` (with `error`).
+
+    With `wait` (in seconds, capped by the server), the request is held until the job finishes or the time is up,
+    so a client can long-poll instead of asking repeatedly. Finished jobs are kept for a few minutes.
+    """
+    job = await app.state.jobs.get(job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job.")
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "queue_depth": app.state.jobs.depth() if job["status"] == "queued" else None,
+        "wait_seconds": job["wait_seconds"],
+        "result": job["result"],
+        "error": job["error"]
+    }
+
+@app.websocket("/classify/stream")
+async def classify_stream_endpoint(websocket: WebSocket):
+    """
+    Classifies a live stream of frames over a WebSocket.
+
+    The client sends each frame as a binary message (e.g. a JPEG) and the server pushes back one JSON message per
+    classified frame with the same fields as `/classify/`, plus `seq`, the 0-based position of the frame in the
+    stream. One frame is analyzed at a time; if new frames arrive meanwhile, only the newest is kept and the
+    others are skipped (counted in `dropped_frames`), so results never fall behind the camera.
+
+    Objects are tracked across the frames of a connection, as with `session_id` on `/classify/`. Pass a
+    `session_id` query parameter to keep the same track IDs after reconnecting. A `budget_ms` query parameter
+    sets the latency budget for each frame, counted from when the frame is taken up for classification.
+    """
+    await websocket.accept()
+    frame_budget_ms = websocket.query_params.get("budget_ms", "")
+    frame_budget_ms = int(frame_budget_ms) if frame_budget_ms.isdigit() else 0
+    session_id = websocket.query_params.get("session_id") or f"stream-{uuid.uuid4().hex}"
+    if not CLARIFAI_API_KEY or not app.state.gemini_keys:
+        await websocket.close(code=1011, reason="API credentials are not fully configured on the server.")
+        return
+
+    latest = None  # (seq, frame) waiting to be classified
+    frame_ready = asyncio.Event()
+    dropped_frames = 0
+
+    async def receive_frames():
+        nonlocal latest, dropped_frames
+        seq = 0
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                frame = message.get("bytes")
+                if frame is None:
+                    continue
+                if latest is not None:
+                    dropped_frames += 1
+                latest = (seq, frame)
+                seq += 1
+                frame_ready.set()
+        finally:
+            frame_ready.set()
+
+    receiver = asyncio.create_task(receive_frames())
+    try:
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            if receiver.done():
+                break
+            if latest is None:
+                continue
+            seq, frame = latest
+            latest = None
+
+            start_time = time.time()
+            with metrics.track_request("stream") as request_metrics:
+                result = await classifier.classify_image(
+                    frame,
+                    clarifai_pat=CLARIFAI_API_KEY,
+                    session_id=session_id,
+                    key_scheduler=app.state.key_scheduler,
+                    detector=app.state.clarifai,
+                    cache=app.state.cache,
+                    local_model=app.state.local_model,
+                    tracker=app.state.tracker,
+                    coalescer=app.state.inflight,
+                    deadline=_deadline(time.monotonic(), frame_budget_ms)
+                )
+                if "error" in result:
+                    request_metrics.outcome = "error"
+            response_time = time.time() - start_time
+            if receiver.done():
+                break  # The client left while the frame was being classified.
+
+            await websocket.send_json({
+                "seq": seq,
+                "api_version": app.version,
+                "model_used": "clarifai-detection + gemini-vision",
+                "response_time": f"{response_time:.2f}s",
+                "dropped_frames": dropped_frames,
+                **result
+            })
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Error during stream classification: {e}")
+    finally:
+        receiver.cancel()
+
 if __name__ == "__main__":
     uvicorn.run("api.main:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
@@ -0,0 +1,186 @@
+import os
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Lightweight in-process metrics in the Prometheus text format. Every worker process keeps its
+# own numbers, so each series carries a `pid` label to tell the workers apart when scraped.
+# Recording a value is a dictionary lookup and a few additions, cheap enough to leave on.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [("pid", os.getpid())] + list(zip(names, values)) + list(extra)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def _format_value(value) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            for labels, value in self._values.items():
+                yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge:
+    """
+    A gauge whose values are read from `collect()` at scrape time.
+    """
+    def __init__(self, name: str, help_text: str, labelnames=(), collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.collect = collect
+        _registry.append(self)
+
+    def render(self):
+        if self.collect is None:
+            return
+        values = self.collect()
+        if not values:
+            return
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            for labels, (counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', le)])} {cumulative}"
+                yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}"
+                yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}"
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram("auro_request_seconds", "End-to-end handling time per classification request.", ("endpoint",))
+REQUESTS = Counter("auro_requests_total", "Classification requests by outcome.", ("endpoint", "outcome"))
+STAGE_SECONDS = Histogram("auro_stage_seconds", "Time spent in each pipeline stage.", ("stage",))
+GEMINI_CALLS_PER_REQUEST = Histogram("auro_gemini_calls_per_request", "Gemini API calls made per classification request.", ("endpoint",), COUNT_BUCKETS)
+REGIONS_PER_IMAGE = Histogram("auro_regions_per_image", "High-confidence regions found by Clarifai per image.", (), COUNT_BUCKETS)
+TIER_DECISIONS = Counter("auro_tier_decisions_total", "Classified objects by the tier that decided them.", ("tier",))
+CACHE_LOOKUPS = Counter("auro_cache_lookups_total", "Result cache lookups.", ("cache", "result"))
+REGIONS_REMOVED = Counter("auro_regions_removed_total", "Detections dropped before analysis, by reason.", ("reason",))
+COALESCED = Counter("auro_coalesced_total", "Work shared with an identical computation already in flight.", ("kind",))
+GEMINI_HEDGES = Counter("auro_gemini_hedges_total", "Slow Gemini calls repeated on a second key.", ("kind",))
+BACKEND_ERRORS = Counter("auro_backend_errors_total", "Errors returned by each backend.", ("backend",))
+LOCAL_MODEL_AGREEMENT = Counter("auro_local_model_agreement_total", "Gemini answers compared with the local model's guess for the same crop.", ("result",))
+JOB_WAIT_SECONDS = Histogram("auro_job_wait_seconds", "Time classification jobs spent queued before a worker took them.", ())
+JOBS = Counter("auro_jobs_total", "Classification jobs by outcome.", ("outcome",))
+REPLAY_MISSES = Counter("auro_replay_misses_total", "Backend calls with no recorded answer in replay mode.", ("backend",))
+
+
+class RequestMetrics:
+    """
+    Stage durations and counters for one request, used for its Server-Timing header. Stages that
+    run concurrently (e.g. several images of a batch) add up, so they can exceed the wall time.
+    """
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.outcome = "ok"
+        self.durations = {}
+        self.counts = {}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.durations.items())
+
+
+_current_request = contextvars.ContextVar("auro_current_request", default=None)
+
+
+@contextmanager
+def track_request(endpoint: str):
+    """
+    Measures one request. Stages and counts recorded while it is active (including in tasks and
+    threads started from it) are attributed to the yielded RequestMetrics.
+    """
+    request = RequestMetrics(endpoint)
+    token = _current_request.set(request)
+    start = time.perf_counter()
+    try:
+        yield request
+    except BaseException:
+        request.outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        request.durations["total"] = elapsed
+        _current_request.reset(token)
+        REQUEST_SECONDS.observe(elapsed, endpoint)
+        REQUESTS.inc(endpoint, request.outcome)
+        GEMINI_CALLS_PER_REQUEST.observe(request.counts.get("gemini_calls", 0), endpoint)
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        request = _current_request.get()
+        if request is not None:
+            request.durations[name] = request.durations.get(name, 0.0) + elapsed
+
+
+def count(name: str, amount: int = 1):
+    request = _current_request.get()
+    if request is not None:
+        request.counts[name] = request.counts.get(name, 0) + amount
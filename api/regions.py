@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+
+# Clean-up of Clarifai's detections before they are analyzed. The detector often returns several
+# overlapping regions for one physical object (a bottle, its cap, its label); each would otherwise
+# cost a Gemini call and come back as a duplicate item.
+REGION_NMS_ENABLED = os.getenv("REGION_NMS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Of two regions overlapping by at least this IoU, only the more confident one is kept.
+REGION_NMS_IOU = float(os.getenv("REGION_NMS_IOU", "0.5"))
+# A region lying at least this much (fraction of its own area) inside a larger, at least as
+# confident one is merged into it, e.g. a cap into its bottle. The larger region must contain
+# only that one region, or all the regions it absorbs must share its concept, so a table or
+# box spanning the belt never swallows the items on it. Set above 1 to turn merging off.
+REGION_CONTAINMENT = float(os.getenv("REGION_CONTAINMENT", "0.9"))
+# Regions smaller than this fraction of the image are dropped. 0 keeps everything.
+REGION_MIN_AREA = float(os.getenv("REGION_MIN_AREA", "0.0"))
+
+
+def box_areas(boxes: np.ndarray) -> np.ndarray:
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+
+def pairwise_intersections(boxes: np.ndarray) -> np.ndarray:
+    """
+    Intersection areas of every pair of [left, top, right, bottom] boxes, as an N x N matrix.
+    """
+    left = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    top = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    right = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    bottom = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    return np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+
+
+def postprocess_boxes(boxes, scores, iou_threshold: float = REGION_NMS_IOU, containment: float = REGION_CONTAINMENT, min_area: float = REGION_MIN_AREA, labels=None):
+    """
+    Filters small boxes, applies non-max suppression and then merges the surviving boxes that are
+    contained in larger ones, in that order. Boxes are in relative [left, top, right, bottom]
+    coordinates.
+
+    A box is only merged into a container at least as confident as itself, and only if that
+    container holds no other box, or holds several that all have its label (from `labels`, e.g.
+    the Clarifai concept names). Without labels, only single boxes are merged.
+
+    Returns `(kept, merged_boxes, reasons)`: the indices of the surviving boxes (in input
+    order), their boxes after merging (each grown to cover what was merged into it), and for
+    every input box either None or why it was removed (`min_area`, `overlap` or `contained`).
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64)
+    count = len(boxes)
+    reasons = [None] * count
+    if count == 0:
+        return [], boxes, reasons
+
+    areas = box_areas(boxes)
+    alive = areas >= min_area if min_area > 0 else np.ones(count, dtype=bool)
+    for index in np.flatnonzero(~alive):
+        reasons[index] = "min_area"
+
+    intersections = pairwise_intersections(boxes)
+    np.fill_diagonal(intersections, 0.0)
+    ious = intersections / np.maximum(areas[:, None] + areas[None, :] - intersections, 1e-12)
+
+    # Greedy NMS, the most confident first. Each step is one vector operation. It runs before
+    # merging, so a contained box is never absorbed into a box that is then suppressed.
+    suppressed = ~alive
+    for index in np.argsort(-scores, kind="stable"):
+        if suppressed[index]:
+            continue
+        newly = (ious[index] >= iou_threshold) & ~suppressed
+        for other in np.flatnonzero(newly):
+            reasons[other] = "overlap"
+        suppressed |= newly
+    alive = ~suppressed
+
+    # contains[i, j]: box j lies (almost) entirely inside the larger box i. Near-duplicates of
+    # about the same size were already settled by the suppression above.
+    contained_share = intersections / np.maximum(areas[None, :], 1e-12)
+    contains = (contained_share >= containment) & (areas[:, None] > areas[None, :]) & (ious < iou_threshold)
+    contains &= alive[:, None] & alive[None, :]
+    contains &= scores[:, None] >= scores[None, :]
+    if labels is not None:
+        labels = np.asarray(labels, dtype=object)
+        same_label = labels[:, None] == labels[None, :]
+    else:
+        same_label = np.zeros((count, count), dtype=bool)
+    # A container holding several boxes is a scene (a table, a tray) rather than one object,
+    # unless they all carry its own label.
+    several = contains.sum(axis=1) > 1
+    contains &= ~several[:, None] | (same_label & ~(contains & ~same_label).any(axis=1)[:, None])
+    # A box only absorbs others if it isn't itself absorbed, so nested boxes end up in the outermost.
+    absorbed = contains.any(axis=0)
+    contains &= ~absorbed[:, None]
+    for index in np.flatnonzero(absorbed & alive):
+        reasons[index] = "contained"
+    alive &= ~absorbed
+
+    merged = boxes.copy()
+    if contains.any():
+        inf = np.inf
+        merged[:, 0] = np.minimum(boxes[:, 0], np.where(contains, boxes[None, :, 0], inf).min(axis=1))
+        merged[:, 1] = np.minimum(boxes[:, 1], np.where(contains, boxes[None, :, 1], inf).min(axis=1))
+        merged[:, 2] = np.maximum(boxes[:, 2], np.where(contains, boxes[None, :, 2], -inf).max(axis=1))
+        merged[:, 3] = np.maximum(boxes[:, 3], np.where(contains, boxes[None, :, 3], -inf).max(axis=1))
+
+    kept = [int(index) for index in np.flatnonzero(alive)]
+    return kept, merged[kept], reasons
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; recording from several processes needs it.
+    fcntl = None
+
+from . import metrics
+
+# Recording and replaying the traffic to Clarifai and Gemini.
+#
+# In "record" mode every upload, Clarifai's detections for it, each Gemini answer and the final
+# result are written to a corpus on disk. In "replay" mode the backends are never called: their
+# answers are served from the corpus, keyed by the content they were asked about, so a recorded
+# day of traffic can be rerun offline through a changed pipeline (see benchmarks/replay_traffic.py).
+BACKEND_MODE = os.getenv("BACKEND_MODE", "live").lower()
+REPLAY_CORPUS_PATH = os.getenv("REPLAY_CORPUS_PATH", "replay_corpus")
+# Replayed answers are delayed by their recorded latency times this factor. 0 answers at once.
+REPLAY_LATENCY_SCALE = float(os.getenv("REPLAY_LATENCY_SCALE", "0"))
+
+# Index entry: which record (by key and kind), where its payload is in the data file, and how
+# long the backend took to produce it.
+INDEX_DTYPE = np.dtype([
+    ("key", "S32"), ("kind", "u1"), ("compressed", "u1"),
+    ("offset", "<u8"), ("length", "<u4"), ("latency_ms", "<f4"),
+])
+KINDS = {"request": 1, "image": 2, "clarifai": 3, "gemini": 4}
+
+
+class ReplayMiss(LookupError):
+    """
+    Raised in replay mode when the corpus has no recorded answer for a backend call.
+    """
+
+
+def content_key(*parts: bytes) -> bytes:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(hashlib.sha256(part).digest())
+    return digest.digest()
+
+
+class BackendCorpus:
+    """
+    An append-only corpus of payloads in `path`: `data.bin` holds the (zlib-compressed, except for
+    images) payloads back to back, and `index.bin` a fixed-size entry per payload. The index is
+    memory-mapped for lookups, so opening a large corpus reads almost nothing.
+
+    Several processes can record into the same corpus; appends are serialized with a file lock.
+    The same key and kind may be stored more than once, in which case the latest entry wins.
+    """
+    def __init__(self, path: str = REPLAY_CORPUS_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._data_path = os.path.join(path, "data.bin")
+        self._index_path = os.path.join(path, "index.bin")
+        self._lock = threading.Lock()
+        self._written = set()
+        self._loaded_entries = -1
+        self._load()
+
+    def _load(self):
+        size = os.path.getsize(self._index_path) if os.path.exists(self._index_path) else 0
+        entries = size // INDEX_DTYPE.itemsize
+        if entries == self._loaded_entries:
+            return
+        self._loaded_entries = entries
+        if entries == 0:
+            self._index = np.zeros(0, dtype=INDEX_DTYPE)
+        else:
+            self._index = np.memmap(self._index_path, dtype=INDEX_DTYPE, mode="r", shape=(entries,))
+        # Sorted by (kind, key) with the recording order kept among equal entries, so the last
+        # match found by binary search is the latest.
+        self._lookup = np.char.add(self._index["kind"].astype("S1"), self._index["key"]) if entries else np.zeros(0, dtype="S33")
+        self._order = np.argsort(self._lookup, kind="stable")
+        self._sorted = self._lookup[self._order]
+
+    def __len__(self):
+        return self._loaded_entries
+
+    def add(self, kind: str, key: bytes, payload: bytes, latency: float = 0.0, once: bool = True):
+        """
+        Appends a payload. With `once`, a key this process already stored under `kind` is skipped.
+        """
+        if once and (kind, key) in self._written:
+            return
+        compressed = kind != "image"
+        data = zlib.compress(payload, 6) if compressed else payload
+        with self._lock:
+            self._written.add((kind, key))
+            with open(self._index_path, "ab") as index_file, open(self._data_path, "ab") as data_file:
+                if fcntl is not None:
+                    fcntl.flock(index_file, fcntl.LOCK_EX)
+                try:
+                    data_file.seek(0, os.SEEK_END)
+                    offset = data_file.tell()
+                    data_file.write(data)
+                    data_file.flush()
+                    entry = np.array([(key, KINDS[kind], compressed, offset, len(data), latency * 1000)], dtype=INDEX_DTYPE)
+                    index_file.write(entry.tobytes())
+                    index_file.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(index_file, fcntl.LOCK_UN)
+
+    def _read(self, entry) -> bytes:
+        with open(self._data_path, "rb") as data_file:
+            data_file.seek(int(entry["offset"]))
+            data = data_file.read(int(entry["length"]))
+        return zlib.decompress(data) if entry["compressed"] else data
+
+    def get(self, kind: str, key: bytes):
+        """
+        Returns `(payload, latency_seconds)` of the latest entry for `key`, or None.
+        """
+        needle = np.array([str(KINDS[kind]).encode() + key], dtype="S33")
+        position = int(np.searchsorted(self._sorted, needle, side="right")[0]) - 1
+        if position < 0 or self._sorted[position] != needle[0]:
+            return None
+        entry = self._index[self._order[position]]
+        return self._read(entry), float(entry["latency_ms"]) / 1000
+
+    def entries(self, kind: str):
+        """
+        Yields `(key, payload, latency_seconds)` for every entry of `kind`, in recording order.
+        """
+        self._load()
+        for entry in self._index[self._index["kind"] == KINDS[kind]]:
+            # NumPy drops trailing zero bytes of fixed-size strings.
+            yield bytes(entry["key"]).ljust(32, b"\0"), self._read(entry), float(entry["latency_ms"]) / 1000
+
+    def record_request(self, image_bytes: bytes, result: dict, elapsed: float):
+        """
+        Stores an upload and what the pipeline made of it.
+        """
+        key = content_key(image_bytes)
+        self.add("image", key, image_bytes)
+        summary = {
+            "image": key.hex(),
+            "received_at": time.time() - elapsed,
+            "trash_items": result.get("trash_items"),
+            "incomplete": result.get("incomplete", False),
+            "error": result.get("error"),
+        }
+        self.add("request", key, json.dumps(summary).encode(), elapsed, once=False)
+
+
+async def _replay_delay(latency: float, deadline: float = None, scale: float = REPLAY_LATENCY_SCALE):
+    delay = latency * scale
+    if deadline is not None and deadline - time.monotonic() < delay:
+        await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+        raise TimeoutError("The request's latency budget is used up.")
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class RecordingDetector:
+    """
+    Wraps a `classifier.ClarifaiDetector` and stores the detections returned for each image.
+    """
+    def __init__(self, detector, corpus: BackendCorpus):
+        self.detector = detector
+        self.corpus = corpus
+
+    async def warm_up(self, timeout: float = 5.0) -> bool:
+        return await self.detector.warm_up(timeout)
+
+    async def detect(self, images, clarifai_pat: str, deadline: float = None):
+        from clarifai_grpc.grpc.api.status import status_code_pb2
+
+        started = time.monotonic()
+        response = await self.detector.detect(images, clarifai_pat, deadline)
+        latency = time.monotonic() - started
+        for image_bytes, output in zip(images, response.outputs):
+            if output.status.code == status_code_pb2.SUCCESS:
+                self.corpus.add("clarifai", content_key(image_bytes), output.SerializeToString(), latency)
+        return response
+
+    async def close(self):
+        await self.detector.close()
+
+
+class ReplayDetector:
+    """
+    Stands in for `classifier.ClarifaiDetector`, answering from the corpus. An image that was never
+    recorded fails the whole call with ReplayMiss.
+    """
+    def __init__(self, corpus: BackendCorpus, latency_scale: float = REPLAY_LATENCY_SCALE):
+        self.corpus = corpus
+        self.latency_scale = latency_scale
+
+    async def warm_up(self, timeout: float = 5.0) -> bool:
+        return True
+
+    async def detect(self, images, clarifai_pat: str, deadline: float = None):
+        from clarifai_grpc.grpc.api import resources_pb2, service_pb2
+        from clarifai_grpc.grpc.api.status import status_code_pb2
+
+        response = service_pb2.MultiOutputResponse()
+        response.status.code = status_code_pb2.SUCCESS
+        latency = 0.0
+        for image_bytes in images:
+            recorded = self.corpus.get("clarifai", content_key(image_bytes))
+            if recorded is None:
+                metrics.REPLAY_MISSES.inc("clarifai")
+                raise ReplayMiss("No recorded Clarifai detections for this image.")
+            response.outputs.append(resources_pb2.Output.FromString(recorded[0]))
+            latency = max(latency, recorded[1])
+        await _replay_delay(latency, deadline, self.latency_scale)
+        return response
+
+    async def close(self):
+        pass
+
+
+def gemini_key(contents, kwargs) -> bytes:
+    """
+    Identifies a Gemini request by its images (in order) and whether a JSON reply was asked for.
+    The prompt text is left out, so rewording a prompt still replays the recorded answers.
+    """
+    parts = [part["data"] for part in contents if isinstance(part, dict)]
+    if kwargs.get("generation_config"):
+        parts.append(b"json")
+    return content_key(*parts)
+
+
+class _ReplayedResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class RecordingModel:
+    """
+    Wraps a Gemini model and stores the text of each answer.
+    """
+    def __init__(self, model, corpus: BackendCorpus):
+        self.model = model
+        self.corpus = corpus
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    async def generate_content_async(self, contents, **kwargs):
+        started = time.monotonic()
+        response = await self.model.generate_content_async(contents, **kwargs)
+        try:
+            text = response.text
+        except ValueError:
+            return response  # Blocked or empty answers aren't worth replaying.
+        self.corpus.add("gemini", gemini_key(contents, kwargs), text.encode(), time.monotonic() - started)
+        return response
+
+
+class ReplayModel:
+    """
+    Stands in for a Gemini model, answering from the corpus.
+    """
+    def __init__(self, corpus: BackendCorpus, latency_scale: float = REPLAY_LATENCY_SCALE):
+        self.corpus = corpus
+        self.latency_scale = latency_scale
+
+    async def generate_content_async(self, contents, **kwargs):
+        recorded = self.corpus.get("gemini", gemini_key(contents, kwargs))
+        if recorded is None:
+            metrics.REPLAY_MISSES.inc("gemini")
+            raise ReplayMiss("No recorded Gemini answer for these images.")
+        timeout = (kwargs.get("request_options") or {}).get("timeout")
+        await _replay_delay(recorded[1], None if timeout is None else time.monotonic() + timeout, self.latency_scale)
+        return _ReplayedResponse(recorded[0].decode())
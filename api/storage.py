@@ -0,0 +1,79 @@
+import os
+import json
+import sqlite3
+import threading
+
+# SQLite helpers shared by the modules that keep state in a file all workers on the machine can see.
+
+
+class SQLiteConnection:
+    """
+    Opens a SQLite connection to `path` on first use, and again in any process forked after that:
+    connections must not be shared across a fork, so each process gets its own. `setup` is called
+    with every new connection to create its tables.
+
+    With `per_thread`, each thread also gets its own connection. Otherwise the one connection may
+    be used from any thread, and callers serialize access to it themselves.
+    """
+    def __init__(self, path: str, setup=None, timeout: float = 2.0, per_thread: bool = False):
+        self.path = path or ":memory:"
+        self.setup = setup
+        self.timeout = timeout
+        self.per_thread = per_thread
+        self._local = threading.local() if per_thread else None
+        self._conn = None
+        self._pid = None
+
+    def get(self) -> sqlite3.Connection:
+        holder = self._local if self.per_thread else self
+        if getattr(holder, "_conn", None) is None or getattr(holder, "_pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=self.per_thread)
+            if self.path != ":memory:":
+                conn.execute("PRAGMA journal_mode=WAL")
+            if self.setup is not None:
+                self.setup(conn)
+            holder._conn = conn
+            holder._pid = os.getpid()
+        return holder._conn
+
+
+class SQLiteStore:
+    """
+    A small key/value table in a SQLite file, used as the shared second level of a ResultCache and
+    for the job state of a JobQueue. Each thread of each process uses its own connection, so the
+    store is safe to use from worker threads and after gunicorn forks.
+    """
+    def __init__(self, path: str, table: str):
+        self.path = path
+        self.table = table
+        self._connection = SQLiteConnection(path, self._create_table, timeout=1.0, per_thread=True).get
+
+    def _create_table(self, conn: sqlite3.Connection):
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+
+    def get(self, key: str, now: float):
+        conn = self._connection()
+        row = conn.execute(f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            return None
+        conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: str, value, expires: float, now: float, max_entries: int):
+        conn = self._connection()
+        conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), expires, now)
+        )
+        conn.execute(f"DELETE FROM {self.table} WHERE expires <= ?", (now,))
+        conn.execute(
+            f"DELETE FROM {self.table} WHERE key IN "
+            f"(SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (max_entries,)
+        )
@@ -0,0 +1,125 @@
+import os
+import copy
+import asyncio
+import contextlib
+
+from .cache import ResultCache
+
+# Per-session object tracking. A client that sends a `session_id` with each frame of the same
+# scene gets stable track IDs for its objects, and objects that haven't moved reuse the category
+# from the previous frame instead of going through Gemini again.
+TRACK_SESSION_TTL_SECONDS = float(os.getenv("TRACK_SESSION_TTL_SECONDS", "60"))
+TRACK_MAX_SESSIONS = int(os.getenv("TRACK_MAX_SESSIONS", "256"))
+# Boxes overlapping a track's last box by at least TRACK_MATCH_IOU continue that track; if they
+# overlap by TRACK_REUSE_IOU or more (and Clarifai still sees the same concept) the track's
+# category is reused as is. Anything in between is re-classified under the same track ID.
+TRACK_MATCH_IOU = float(os.getenv("TRACK_MATCH_IOU", "0.3"))
+TRACK_REUSE_IOU = float(os.getenv("TRACK_REUSE_IOU", "0.6"))
+# Frames a track may go unseen (e.g. hidden by the arm) before it is forgotten.
+TRACK_MAX_MISSED_FRAMES = int(os.getenv("TRACK_MAX_MISSED_FRAMES", "3"))
+# Optional SQLite file shared by all workers, so a session keeps its tracks whichever worker
+# handles the next frame. Leave unset for in-process only.
+TRACK_STATE_PATH = os.getenv("TRACK_STATE_PATH")
+
+
+def iou(a, b) -> float:
+    """
+    Intersection over union of two [left, top, right, bottom] boxes.
+    """
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class ObjectTracker:
+    """
+    Matches each frame's detections to the tracks of its session by box overlap.
+
+    Sessions are kept in a ResultCache, so they expire TRACK_SESSION_TTL_SECONDS after the last
+    frame, the least recently used are dropped beyond TRACK_MAX_SESSIONS, and with `path` they
+    are shared between workers.
+
+    A frame's `match` and `update` must both run under `lock(session_id)`; otherwise two frames of
+    one session in flight at once hand out the same track IDs and one frame's tracks are lost.
+    The lock only covers this process, so with `path` a session's frames should still be sent
+    one at a time.
+    """
+    def __init__(self, ttl_seconds: float = TRACK_SESSION_TTL_SECONDS, max_sessions: int = TRACK_MAX_SESSIONS, path: str = TRACK_STATE_PATH, match_iou: float = TRACK_MATCH_IOU, reuse_iou: float = TRACK_REUSE_IOU, max_missed_frames: int = TRACK_MAX_MISSED_FRAMES):
+        self.sessions = ResultCache("track", max_sessions, ttl_seconds, path)
+        self.match_iou = match_iou
+        self.reuse_iou = reuse_iou
+        self.max_missed_frames = max_missed_frames
+        # session_id -> [lock, number of frames holding or waiting for it]
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def lock(self, session_id: str):
+        """
+        Holds the session for one frame, from `match` to `update`. Frames of the same session
+        are taken in the order they arrive.
+        """
+        entry = self._locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[session_id]
+
+    async def match(self, session_id: str, detections):
+        """
+        Assigns a track to every detection, given as (clarifai_name, box) pairs.
+
+        Returns the session state to pass to `update` and, per detection, a (track_id, category)
+        pair where category is the track's previous category if it can be reused, else None.
+        Pairs are matched greedily, most overlapping first.
+        """
+        session = copy.deepcopy(await self.sessions.get(session_id)) or {"next_id": 1, "tracks": []}
+        tracks = session["tracks"]
+
+        pairs = sorted(
+            ((iou(box, track["box"]), d, t) for d, (_, box) in enumerate(detections) for t, track in enumerate(tracks)),
+            reverse=True
+        )
+        assigned = [None] * len(detections)
+        taken = set()
+        for overlap, d, t in pairs:
+            if overlap < self.match_iou:
+                break
+            if assigned[d] is not None or t in taken:
+                continue
+            track = tracks[t]
+            name = detections[d][0]
+            reusable = overlap >= self.reuse_iou and name == track["name"] and track["category"] is not None
+            assigned[d] = (track["id"], track["category"] if reusable else None)
+            taken.add(t)
+
+        for d in range(len(detections)):
+            if assigned[d] is None:
+                assigned[d] = (session["next_id"], None)
+                session["next_id"] += 1
+
+        session["unmatched"] = [track for t, track in enumerate(tracks) if t not in taken]
+        return session, assigned
+
+    async def update(self, session_id: str, session: dict, detections, track_ids, categories):
+        """
+        Stores this frame's boxes and categories as the session's tracks. A category of "error"
+        isn't kept, so the object is re-classified on the next frame.
+        """
+        tracks = [
+            {"id": track_id, "name": name, "box": list(box), "category": category if category != "error" else None, "missed": 0}
+            for (name, box), track_id, category in zip(detections, track_ids, categories)
+        ]
+        for track in session.pop("unmatched", []):
+            track["missed"] += 1
+            if track["missed"] <= self.max_missed_frames:
+                tracks.append(track)
+        session["tracks"] = tracks
+        await self.sessions.set(session_id, session)
@@ -0,0 +1,150 @@
+import json
+import random
+import asyncio
+import argparse
+
+import grpc
+from clarifai_grpc.grpc.api import service_pb2, service_pb2_grpc
+from clarifai_grpc.grpc.api.status import status_code_pb2
+import google.ai.generativelanguage as glm
+
+# Local stand-ins for the Clarifai and Gemini gRPC services, so the API can be load tested
+# without network access or quota. Both speak plaintext gRPC; point the API at them with
+# CLARIFAI_GRPC_BASE + CLARIFAI_GRPC_INSECURE and GEMINI_API_ENDPOINT + GEMINI_GRPC_INSECURE.
+
+GEMINI_SERVICE = "google.ai.generativelanguage.v1beta.GenerativeService"
+CATEGORIES = ["paper", "plastic", "glass", "metal", "e-waste", "organic", "other"]
+
+
+async def _delay(latency_ms: float, jitter_ms: float):
+    seconds = max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000.0
+    if seconds:
+        await asyncio.sleep(seconds)
+
+
+class FakeClarifai(service_pb2_grpc.V2Servicer):
+    """
+    Answers PostModelOutputs with `regions` random detections per input, named after `concepts`.
+    With probability `error_rate` the whole call comes back with a FAILURE status.
+    """
+    def __init__(self, latency_ms: float = 150, jitter_ms: float = 50, error_rate: float = 0.0, regions: int = 4, concepts=("bottle", "can", "jar", "box", "object")):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.regions = regions
+        self.concepts = list(concepts)
+        self.calls = 0
+
+    async def PostModelOutputs(self, request, context):
+        self.calls += 1
+        await _delay(self.latency_ms, self.jitter_ms)
+        response = service_pb2.MultiOutputResponse()
+        if random.random() < self.error_rate:
+            response.status.code = status_code_pb2.FAILURE
+            response.status.description = "Fake Clarifai failure"
+            return response
+
+        response.status.code = status_code_pb2.SUCCESS
+        for _ in request.inputs:
+            output = response.outputs.add()
+            output.status.code = status_code_pb2.SUCCESS
+            for _ in range(self.regions):
+                left, top = random.uniform(0.0, 0.6), random.uniform(0.0, 0.6)
+                width, height = random.uniform(0.15, 0.4), random.uniform(0.15, 0.4)
+                region = output.data.regions.add()
+                box = region.region_info.bounding_box
+                box.left_col, box.top_row = left, top
+                box.right_col, box.bottom_row = min(1.0, left + width), min(1.0, top + height)
+                concept = region.data.concepts.add()
+                concept.name = random.choice(self.concepts)
+                concept.value = random.uniform(0.65, 0.99)
+        return response
+
+
+class FakeGemini:
+    """
+    Answers GenerateContent with a random material category, or a JSON list of them when the
+    request asks for `application/json` (batched analysis). With probability `error_rate` the
+    call fails with INTERNAL.
+    """
+    def __init__(self, latency_ms: float = 400, jitter_ms: float = 150, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.calls = 0
+
+    async def generate_content(self, request, context):
+        self.calls += 1
+        await _delay(self.latency_ms, self.jitter_ms)
+        if random.random() < self.error_rate:
+            await context.abort(grpc.StatusCode.INTERNAL, "Fake Gemini failure")
+
+        images = sum(1 for content in request.contents for part in content.parts if part.inline_data.data)
+        if request.generation_config.response_mime_type == "application/json":
+            text = json.dumps([random.choice(CATEGORIES) for _ in range(images)])
+        else:
+            text = random.choice(CATEGORIES)
+        return glm.GenerateContentResponse(candidates=[glm.Candidate(
+            content=glm.Content(role="model", parts=[glm.Part(text=text)]),
+            finish_reason=glm.Candidate.FinishReason.STOP,
+            index=0,
+        )])
+
+    def handler(self):
+        return grpc.method_handlers_generic_handler(GEMINI_SERVICE, {
+            "GenerateContent": grpc.unary_unary_rpc_method_handler(
+                self.generate_content,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+        })
+
+
+async def serve(clarifai: FakeClarifai, gemini: FakeGemini, clarifai_port: int, gemini_port: int):
+    clarifai_server = grpc.aio.server()
+    service_pb2_grpc.add_V2Servicer_to_server(clarifai, clarifai_server)
+    clarifai_server.add_insecure_port(f"127.0.0.1:{clarifai_port}")
+
+    gemini_server = grpc.aio.server()
+    gemini_server.add_generic_rpc_handlers((gemini.handler(),))
+    gemini_server.add_insecure_port(f"127.0.0.1:{gemini_port}")
+
+    await clarifai_server.start()
+    await gemini_server.start()
+    print(f"Fake Clarifai listening on 127.0.0.1:{clarifai_port}, fake Gemini on 127.0.0.1:{gemini_port}.", flush=True)
+    try:
+        await asyncio.gather(clarifai_server.wait_for_termination(), gemini_server.wait_for_termination())
+    finally:
+        await clarifai_server.stop(None)
+        await gemini_server.stop(None)
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--clarifai-port", type=int, default=50151)
+    parser.add_argument("--gemini-port", type=int, default=50152)
+    parser.add_argument("--clarifai-latency-ms", type=float, default=150)
+    parser.add_argument("--gemini-latency-ms", type=float, default=400)
+    parser.add_argument("--jitter-ms", type=float, default=50, help="Uniform +/- jitter added to both latencies.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls to each backend that fail.")
+    parser.add_argument("--regions", type=int, default=4, help="Detections returned per image.")
+    parser.add_argument("--concepts", default="bottle,can,jar,box,object", help="Comma-separated concept names to draw detections from.")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run local stand-ins for the Clarifai and Gemini gRPC services.")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    clarifai = FakeClarifai(args.clarifai_latency_ms, args.jitter_ms, args.error_rate, args.regions, args.concepts.split(","))
+    gemini = FakeGemini(args.gemini_latency_ms, args.jitter_ms, args.error_rate)
+    try:
+        asyncio.run(serve(clarifai, gemini, args.clarifai_port, args.gemini_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
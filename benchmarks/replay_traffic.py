@@ -0,0 +1,134 @@
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+from api import classifier
+from api.replay import BackendCorpus, ReplayDetector, REPLAY_CORPUS_PATH, REPLAY_LATENCY_SCALE
+
+from .run_benchmark import _percentile
+
+# Reruns recorded traffic through the current pipeline, offline.
+#
+# Every upload in a corpus recorded with BACKEND_MODE=record is classified again in this process,
+# with Clarifai and Gemini answered from the corpus instead of the network. Each result is compared
+# with the one recorded at the time, and the recorded and replayed latencies are reported side by
+# side, so a pipeline change can be checked against a day of real traffic before it is deployed.
+# Backend calls the corpus has no answer for (e.g. because the change crops differently) are
+# reported apart from real differences: a missing Clarifai answer fails the request (an error),
+# and a request with a crop whose Gemini answer is missing counts as a replay miss. Both are also
+# counted in auro_replay_misses_total.
+
+
+def _items(result: dict):
+    """
+    A result's items as comparable (category, box) pairs, boxes rounded to absorb float noise.
+    """
+    return sorted((item["category"], tuple(round(value, 3) for value in item["bounding_box"])) for item in result.get("trash_items") or [])
+
+
+async def replay(args) -> dict:
+    corpus = BackendCorpus(args.corpus)
+    classifier.use_corpus(corpus, "replay", args.latency_scale)
+    detector = ReplayDetector(corpus, args.latency_scale)
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+
+    requests = []
+    for _, payload, latency in corpus.entries("request"):
+        requests.append((json.loads(payload), latency))
+        if args.limit and len(requests) >= args.limit:
+            break
+
+    async def run(recorded: dict, recorded_latency: float) -> dict:
+        image = corpus.get("image", bytes.fromhex(recorded["image"]))
+        if image is None:
+            return {"recorded": recorded, "error": "The recorded image is missing from the corpus."}
+        async with semaphore:
+            started = time.monotonic()
+            result = await classifier.classify_image(image[0], "replay", "replay", detector=detector)
+            elapsed = time.monotonic() - started
+        # With a single key ("replay") there are no rate limits or cooldowns, so a replayed Gemini
+        # call only fails when the corpus has no answer. That drops the crop's item, but the debug
+        # info still lists it as an "error". Frames without detections list a message instead.
+        misses = sum(
+            1 for item in result.get("debug_info", {}).get("final_classifications", [])
+            if isinstance(item, dict) and item.get("decided_by") == "gemini" and item.get("category") == "error"
+        )
+        return {"recorded": recorded, "recorded_latency": recorded_latency, "result": result, "latency": elapsed, "misses": misses}
+
+    started = time.monotonic()
+    runs = await asyncio.gather(*(run(recorded, latency) for recorded, latency in requests))
+    total = time.monotonic() - started
+
+    same, changed, errors, misses = 0, [], 0, 0
+    categories = Counter()
+    for entry in runs:
+        result = entry.get("result") or entry
+        if result.get("error"):
+            errors += 1
+            changed.append({"image": entry["recorded"]["image"], "error": result["error"]})
+            continue
+        if entry["misses"]:
+            misses += 1
+            changed.append({"image": entry["recorded"]["image"], "replay_misses": entry["misses"]})
+            continue
+        recorded_items, replayed_items = _items(entry["recorded"]), _items(result)
+        if recorded_items == replayed_items:
+            same += 1
+            continue
+        changed.append({"image": entry["recorded"]["image"], "recorded": recorded_items, "replayed": replayed_items})
+        for (before, _), (after, _) in zip(recorded_items, replayed_items):
+            if before != after:
+                categories[f"{before} -> {after}"] += 1
+
+    def to_ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 1)
+
+    recorded_latencies = sorted(entry["recorded_latency"] for entry in runs if "latency" in entry)
+    replayed_latencies = sorted(entry["latency"] for entry in runs if "latency" in entry)
+    return {
+        "corpus": args.corpus,
+        "latency_scale": args.latency_scale,
+        "requests": len(runs),
+        "same": same,
+        "changed": len(changed) - errors - misses,
+        "errors": errors,
+        "replay_misses": misses,
+        "agreement": round(same / len(runs), 4) if runs else None,
+        "category_changes": dict(categories.most_common()),
+        "seconds": round(total, 2),
+        "recorded_p50_ms": to_ms(_percentile(recorded_latencies, 0.50)),
+        "recorded_p95_ms": to_ms(_percentile(recorded_latencies, 0.95)),
+        "replayed_p50_ms": to_ms(_percentile(replayed_latencies, 0.50)),
+        "replayed_p95_ms": to_ms(_percentile(replayed_latencies, 0.95)),
+        "differences": changed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rerun traffic recorded with BACKEND_MODE=record through the current pipeline.")
+    parser.add_argument("--corpus", default=REPLAY_CORPUS_PATH, help="The recorded corpus directory.")
+    parser.add_argument("--latency-scale", type=float, default=REPLAY_LATENCY_SCALE, help="Delay replayed answers by their recorded latency times this (0 = no delay).")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests replayed at the same time.")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first this many requests (0 = all).")
+    parser.add_argument("--output", default="replay_results.json", help="Where to write the comparison, including every difference.")
+    args = parser.parse_args()
+
+    results = asyncio.run(replay(args))
+
+    print(f"Replayed {results['requests']} requests in {results['seconds']}s.")
+    if results["requests"]:
+        print(f"  same result: {results['same']} ({results['agreement']:.1%}), changed: {results['changed']}, errors: {results['errors']}, replay misses: {results['replay_misses']}")
+    for change, count in results["category_changes"].items():
+        print(f"  {change}: {count}")
+    print(f"  recorded latency p50/p95: {results['recorded_p50_ms'] or '-'} / {results['recorded_p95_ms'] or '-'} ms")
+    print(f"  replayed latency p50/p95: {results['replayed_p50_ms'] or '-'} / {results['replayed_p95_ms'] or '-'} ms")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
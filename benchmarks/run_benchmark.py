@@ -0,0 +1,315 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+
+import httpx
+from PIL import Image
+
+from .fake_backends import add_backend_arguments
+
+# Load test for `api.main:app` against the local backend stand-ins in fake_backends.py.
+#
+# The fake backends and the API server each run in their own process; this script only drives
+# /classify/ with a fixed number of concurrent clients per level and reports throughput, latency
+# percentiles and the server's peak memory. Results are written as JSON, and a previous result
+# file can be given as a baseline to fail the run when throughput regresses.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _make_images(count: int, width: int, height: int):
+    """
+    Distinct noisy JPEGs, so compression and decoding cost roughly what a camera frame would.
+    """
+    images = []
+    for i in range(count):
+        image = Image.effect_noise((width, height), 40 + i).convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def _rss_mb(pid: int):
+    """
+    Resident memory of a process in MiB, or None where /proc isn't available.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def _children(pid: int):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+
+def _server_rss_mb(pid: int):
+    # With --workers > 1 uvicorn forks; the footprint is the sum over the whole process tree.
+    pending, total = [pid], None
+    while pending:
+        current = pending.pop()
+        rss = _rss_mb(current)
+        if rss is not None:
+            total = (total or 0.0) + rss
+        pending += _children(current)
+    return total
+
+
+def _percentile(sorted_values, fraction: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def _wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("The API server exited during startup.")
+            try:
+                if (await client.get(f"{url}/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("The API server did not become ready in time.")
+
+
+async def run_level(url: str, images, concurrency: int, duration: float, warmup: float, server_pid: int) -> dict:
+    """
+    Keeps `concurrency` clients posting images back to back for `duration` seconds (after an
+    untimed warm-up) and summarizes the completed requests.
+    """
+    latencies = []
+    errors = 0
+    peak_rss = None
+    measuring = False
+    stop_at = time.monotonic() + warmup + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async def client_loop(client: httpx.AsyncClient):
+        nonlocal errors
+        while time.monotonic() < stop_at:
+            image = random.choice(images)
+            start = time.perf_counter()
+            try:
+                response = await client.post(f"{url}/classify/", files={"file": ("frame.jpg", image, "image/jpeg")})
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            elapsed = time.perf_counter() - start
+            if not measuring:
+                continue
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while time.monotonic() < stop_at:
+            rss = _server_rss_mb(server_pid)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0.0, rss)
+            await asyncio.sleep(0.1)
+
+    async with httpx.AsyncClient(timeout=60.0, limits=limits) as client:
+        clients = [asyncio.create_task(client_loop(client)) for _ in range(concurrency)]
+        sampler = asyncio.create_task(sample_memory())
+        await asyncio.sleep(warmup)
+        measuring = True
+        started = time.monotonic()
+        await asyncio.gather(*clients)
+        elapsed = time.monotonic() - started
+        await sampler
+
+    latencies.sort()
+    to_ms = lambda seconds: None if seconds is None else round(seconds * 1000, 1)
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "req_per_s": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50_ms": to_ms(_percentile(latencies, 0.50)),
+        "p95_ms": to_ms(_percentile(latencies, 0.95)),
+        "p99_ms": to_ms(_percentile(latencies, 0.99)),
+        "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+    }
+
+
+def check_regression(results: dict, baseline: dict, max_drop: float):
+    """
+    Returns a message for every concurrency level whose throughput fell more than `max_drop`
+    (a fraction) below the baseline. Levels missing from either run are ignored.
+    """
+    previous = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    failures = []
+    for level in results["levels"]:
+        before = previous.get(level["concurrency"])
+        if not before or not before.get("req_per_s"):
+            continue
+        floor = before["req_per_s"] * (1.0 - max_drop)
+        if level["req_per_s"] < floor:
+            failures.append(
+                f"concurrency {level['concurrency']}: {level['req_per_s']} req/s is below "
+                f"{floor:.2f} req/s ({before['req_per_s']} req/s baseline, {max_drop:.0%} allowed drop)"
+            )
+    return failures
+
+
+def backend_command(args, clarifai_port: int, gemini_port: int):
+    """
+    The command starting fake_backends.py with the backend options given on the command line.
+    """
+    command = [
+        sys.executable, "-m", "benchmarks.fake_backends",
+        "--clarifai-port", str(clarifai_port), "--gemini-port", str(gemini_port),
+        "--clarifai-latency-ms", str(args.clarifai_latency_ms), "--gemini-latency-ms", str(args.gemini_latency_ms),
+        "--jitter-ms", str(args.jitter_ms), "--error-rate", str(args.error_rate),
+        "--regions", str(args.regions), "--concepts", args.concepts,
+    ]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    return command
+
+
+def server_env(clarifai_port: int, gemini_port: int, gemini_keys: int, cache: bool = False) -> dict:
+    """
+    Environment for an API server that talks to the fake backends on the given ports.
+    """
+    env = dict(os.environ)
+    env.update({
+        "CLARIFAI_API_KEY": "benchmark",
+        "CLARIFAI_GRPC_BASE": f"127.0.0.1:{clarifai_port}",
+        "CLARIFAI_GRPC_INSECURE": "true",
+        "GEMINI_API_ENDPOINT": f"127.0.0.1:{gemini_port}",
+        "GEMINI_GRPC_INSECURE": "true",
+        # Enough fake keys with effectively unlimited budget, so the scheduler never throttles.
+        "GEMINI_API_KEY": "benchmark-1",
+        **{f"GEMINI_API_KEY_{i}": f"benchmark-{i}" for i in range(2, gemini_keys + 1)},
+        "GEMINI_KEY_RPM": "1000000",
+        "GEMINI_KEY_BURST": "1000000",
+        "GEMINI_KEY_RPD": "0",
+        "GEMINI_KEY_STATE_PATH": "",
+        "CACHE_ENABLED": "true" if cache else "false",
+    })
+    return env
+
+
+async def benchmark(args) -> dict:
+    clarifai_port = args.clarifai_port or _free_port()
+    gemini_port = args.gemini_port or _free_port()
+    api_port = args.api_port or _free_port()
+    url = f"http://127.0.0.1:{api_port}"
+
+    env = server_env(clarifai_port, gemini_port, args.gemini_keys, args.cache)
+    server_command = [
+        sys.executable, "-m", "uvicorn", "api.main:app",
+        "--host", "127.0.0.1", "--port", str(api_port),
+        "--workers", str(args.workers), "--log-level", "warning", "--no-access-log",
+    ]
+
+    images = _make_images(args.images, args.width, args.height)
+    backends = subprocess.Popen(backend_command(args, clarifai_port, gemini_port), cwd=REPO_ROOT)
+    server = subprocess.Popen(server_command, cwd=REPO_ROOT, env=env)
+    try:
+        await _wait_until_ready(url, server)
+        levels = []
+        for concurrency in args.concurrency:
+            print(f"Running {concurrency} concurrent clients for {args.duration:.0f}s...", flush=True)
+            levels.append(await run_level(url, images, concurrency, args.duration, args.warmup, server.pid))
+    finally:
+        for process in (server, backends):
+            process.terminate()
+        for process in (server, backends):
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {
+            key: getattr(args, key) for key in (
+                "duration", "warmup", "workers", "images", "width", "height", "cache", "gemini_keys",
+                "clarifai_latency_ms", "gemini_latency_ms", "jitter_ms", "error_rate", "regions", "concepts", "seed",
+            )
+        },
+        "levels": levels,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the AURo API against local Clarifai/Gemini stand-ins.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrent clients for each level.")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds per level.")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Unmeasured seconds before each level.")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes.")
+    parser.add_argument("--api-port", type=int, default=0)
+    parser.add_argument("--images", type=int, default=8, help="Distinct test images to cycle through.")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--cache", action="store_true", help="Leave the result cache enabled.")
+    parser.add_argument("--gemini-keys", type=int, default=4)
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results.")
+    parser.add_argument("--baseline", help="A previous results file to compare throughput against.")
+    parser.add_argument("--max-drop", type=float, default=0.10, help="Allowed throughput drop versus the baseline, as a fraction.")
+    add_backend_arguments(parser)
+    # Pick free ports unless told otherwise.
+    parser.set_defaults(clarifai_port=0, gemini_port=0)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    results = asyncio.run(benchmark(args))
+
+    print(f"\n{'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'RSS MiB':>8}")
+    for level in results["levels"]:
+        print(
+            f"{level['concurrency']:>8} {level['req_per_s']:>8} {level['p50_ms'] or '-':>8} {level['p95_ms'] or '-':>8} "
+            f"{level['p99_ms'] or '-':>8} {level['errors']:>7} {level['peak_rss_mb'] or '-':>8}"
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = check_regression(results, json.load(f), args.max_drop)
+        if failures:
+            print("Throughput regression:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        print(f"No throughput regression against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+
+from .fake_backends import add_backend_arguments
+from .run_benchmark import REPO_ROOT, _free_port, _wait_until_ready, backend_command, server_env
+
+# Cold start check for the API.
+#
+# Measures, each in fresh processes, how long `import api.main` takes and how long a newly
+# started server (run against the fake backends, so the warm-up handshakes are included) takes
+# until /health answers. Exits with status 1 if `import api.main` loads any of LAZY_MODULES, so a
+# heavy import sneaking back into module scope is caught before it slows down every cold start,
+# or if the median of either time exceeds its limit.
+
+# Backend SDKs that must only be imported on first use (or by PRELOAD_BACKENDS).
+LAZY_MODULES = ("google.generativeai", "clarifai_grpc")
+# Default limits: about twice the medians measured on a clean tree (0.5-0.75s to import, most of
+# it FastAPI itself, and about 1.5s until ready). They catch gross slowdowns; machine-to-machine
+# noise is too large for them to catch a single SDK import, which LAZY_MODULES is for.
+MAX_IMPORT_SECONDS = 1.5
+MAX_READY_SECONDS = 5.0
+
+IMPORT_SNIPPET = (
+    "import sys, time; started = time.perf_counter(); import api.main; elapsed = time.perf_counter() - started; "
+    f"print(' '.join(name for name in {LAZY_MODULES!r} if name in sys.modules)); print(elapsed)"
+)
+
+
+def measure_import(env: dict):
+    """
+    Returns how long `import api.main` took in a fresh process, and which of LAZY_MODULES it loaded.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], cwd=REPO_ROOT, env=env,
+        check=True, capture_output=True, text=True
+    ).stdout
+    loaded, seconds = output.rstrip("\n").split("\n")[-2:]
+    return float(seconds), loaded.split()
+
+
+async def measure_ready(env: dict, workers: int) -> float:
+    port = _free_port()
+    command = [
+        sys.executable, "-m", "uvicorn", "api.main:app", "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning", "--no-access-log",
+    ]
+    started = time.monotonic()
+    server = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        await _wait_until_ready(f"http://127.0.0.1:{port}", server, timeout=60.0)
+        return time.monotonic() - started
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check how quickly the AURo API imports and starts serving.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes measured for each figure.")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes for the startup measurement.")
+    parser.add_argument("--gemini-keys", type=int, default=4)
+    parser.add_argument("--max-import-seconds", type=float, default=MAX_IMPORT_SECONDS, help="Allowed median time for `import api.main`.")
+    parser.add_argument("--max-ready-seconds", type=float, default=MAX_READY_SECONDS, help="Allowed median time until /health answers.")
+    add_backend_arguments(parser)
+    parser.set_defaults(clarifai_port=0, gemini_port=0)
+    args = parser.parse_args()
+
+    clarifai_port = args.clarifai_port or _free_port()
+    gemini_port = args.gemini_port or _free_port()
+    env = server_env(clarifai_port, gemini_port, args.gemini_keys)
+    backends = subprocess.Popen(backend_command(args, clarifai_port, gemini_port), cwd=REPO_ROOT)
+    try:
+        imports, loaded = [], set()
+        for _ in range(args.runs):
+            seconds, modules = measure_import(env)
+            imports.append(seconds)
+            loaded.update(modules)
+        readies = [asyncio.run(measure_ready(env, args.workers)) for _ in range(args.runs)]
+    finally:
+        backends.terminate()
+        backends.wait(timeout=10)
+
+    failures = []
+    if loaded:
+        failures.append(f"import api.main loaded {', '.join(sorted(loaded))}, which must only be imported on first use")
+    for name, values, limit in (("import api.main", imports, args.max_import_seconds), ("ready to serve", readies, args.max_ready_seconds)):
+        median = statistics.median(values)
+        print(f"{name:>16}: median {median:.3f}s, min {min(values):.3f}s, max {max(values):.3f}s (limit {limit:.2f}s)")
+        if median > limit:
+            failures.append(f"{name} took {median:.3f}s, over the {limit:.2f}s limit")
+
+    if failures:
+        print("Startup regression:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("Startup time is within limits.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import cv2
+import threading
+import time
+from collections import deque
+
+
+class FrameSource:
+    """
+    Reads a video stream (e.g. the phone's MJPEG `/video` URL) in a background thread over one
+    persistent connection.
+
+    Only the newest frame is kept; readers get it without waiting on the camera, and frames
+    nobody asked for are simply overwritten. Opening the stream and reading a frame each give up
+    after `open_timeout` and `read_timeout` seconds. If the stream can't be opened or stops
+    delivering frames, the capture is reopened with exponential backoff between `min_backoff`
+    and `max_backoff` seconds.
+    """
+    def __init__(self, url, min_backoff=0.5, max_backoff=8.0, open_timeout=5.0, read_timeout=5.0):
+        self.url = url
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.open_timeout = open_timeout
+        self.read_timeout = read_timeout
+        self._frame = None
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._seq = 0
+        self._connected = False
+        self._reconnects = 0
+        self._read_seconds = deque(maxlen=100)
+        self._started = None
+
+    def start(self, timeout=5.0):
+        """
+        Starts the capture thread and waits up to `timeout` seconds for the first frame.
+        Returns True if a frame arrived in time.
+        """
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="frame-source", daemon=True)
+        self._thread.start()
+        return self.wait_newer(0, timeout) is not None
+
+    def stop(self):
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _open(self):
+        cap = cv2.VideoCapture(self.url, cv2.CAP_ANY, [
+            cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(self.open_timeout * 1000),
+            cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(self.read_timeout * 1000),
+        ])
+        if cap.isOpened():
+            return cap
+        cap.release()
+        return None
+
+    def _run(self):
+        backoff = self.min_backoff
+        cap = None
+        while not self._stop.is_set():
+            if cap is None:
+                cap = self._open()
+                if cap is None:
+                    print(f"Could not open video stream at {self.url}; retrying in {backoff:.1f}s")
+                    self._stop.wait(backoff)
+                    backoff = min(self.max_backoff, backoff * 2)
+                    continue
+                if self._seq:
+                    self._reconnects += 1
+                self._connected = True
+
+            read_started = time.monotonic()
+            ret, frame = cap.read()
+            read_finished = time.monotonic()
+            if not ret or frame is None:
+                print(f"Lost the video stream at {self.url}; reconnecting in {backoff:.1f}s")
+                cap.release()
+                cap = None
+                self._connected = False
+                self._stop.wait(backoff)
+                backoff = min(self.max_backoff, backoff * 2)
+                continue
+
+            backoff = self.min_backoff
+            self._read_seconds.append(read_finished - read_started)
+            with self._condition:
+                self._seq += 1
+                self._frame = (self._seq, frame, read_finished)
+                self._condition.notify_all()
+
+        if cap is not None:
+            cap.release()
+        self._connected = False
+
+    def latest(self):
+        """
+        Returns the newest frame as `(seq, frame, captured_at)`, or None if none has arrived yet.
+        `captured_at` is a `time.monotonic()` value. Never blocks on the camera.
+        """
+        with self._condition:
+            return self._frame
+
+    def wait_newer(self, seq, timeout=None):
+        """
+        Waits up to `timeout` seconds for a frame newer than `seq` and returns the newest one,
+        or None if there is none by then.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._stop.is_set() and not (self._frame and self._frame[0] > seq):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            if self._frame and self._frame[0] > seq:
+                return self._frame
+            return None
+
+    def stats(self):
+        """
+        Capture figures: frames read, average capture FPS since start, the recent average time
+        per read, the age of the newest frame and the number of reconnects.
+        """
+        elapsed = time.monotonic() - self._started if self._started else 0
+        newest = self.latest()
+        reads = list(self._read_seconds)
+        return {
+            "connected": self._connected,
+            "frames": self._seq,
+            "fps": self._seq / elapsed if elapsed > 0 else 0.0,
+            "read_ms": 1000 * sum(reads) / len(reads) if reads else None,
+            "age_ms": 1000 * (time.monotonic() - newest[2]) if newest else None,
+            "reconnects": self._reconnects,
+        }
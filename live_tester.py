@@ -2,29 +2,10 @@ import cv2
 import requests
 import numpy as np
 import argparse
-
-def get_frame_from_phone(video_url):
-    """
-    Captures a single frame from the phone's IP camera stream.
-    """
-    try:
-        cap = cv2.VideoCapture(video_url)
-        if not cap.isOpened():
-            print(f"Error: Could not open video stream at {video_url}")
-            print("Please check the URL and ensure the IP Webcam app is running.")
-            return None
-        
-        ret, frame = cap.read()
-        cap.release()
-        
-        if not ret or frame is None:
-            print("Error: Failed to read frame from the stream.")
-            return None
-            
-        return frame
-    except Exception as e:
-        print(f"An error occurred while getting the frame: {str(e)}")
-        return None
+import threading
+import time
+from frame_source import FrameSource
+from scene_gate import add_gate_arguments, gate_from_arguments
 
 def classify_frame(api_url, frame):
     """
@@ -55,6 +36,139 @@ def classify_frame(api_url, frame):
         print(f"An error occurred during classification: {str(e)}")
         return None
 
+class FrameClaims:
+    """
+    Lets several uploaders share one FrameSource: each call to `take` claims the newest frame no
+    uploader has taken yet, so every frame is sent at most once. Frames that were overwritten
+    before anyone claimed them are the dropped ones. With a `gate`, frames it doesn't let through
+    are skipped as well.
+    """
+    def __init__(self, source, gate=None):
+        self.source = source
+        self.gate = gate
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.sent = 0
+
+    def take(self, stop):
+        with self.lock:
+            while not stop.is_set():
+                newest = self.source.wait_newer(self.seq, timeout=0.5)
+                if newest is None:
+                    continue
+                self.seq = newest[0]
+                if self.gate is None or self.gate.update(newest[1]):
+                    self.sent += 1
+                    return newest
+        return None
+
+def upload_loop(session, api_url, claims, results, stats, stop):
+    """
+    Uploader thread: sends frames one after another over the shared keep-alive session.
+    """
+    while not stop.is_set():
+        taken = claims.take(stop)
+        if taken is None:
+            return
+        seq, frame, _ = taken
+        started = time.monotonic()
+        is_success, buffer = cv2.imencode(".jpg", cv2.resize(frame, (640, 480)))
+        if not is_success:
+            continue
+        try:
+            response = session.post(api_url, files={'file': ('image.jpg', buffer.tobytes(), 'image/jpeg')}, timeout=30)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Frame {seq}: request failed: {str(e)}")
+            with stats["lock"]:
+                stats["failed"] += 1
+            continue
+        finished = time.monotonic()
+        with stats["lock"]:
+            stats["round_trips"].append(finished - started)
+            stats["completed"] += 1
+            # Results can arrive out of order; only a newer frame's result replaces the overlay.
+            if seq > results["seq"]:
+                results.update(seq=seq, items=result.get("trash_items", []), round_trip=finished - started)
+
+def draw_items(frame, items):
+    height, width, _ = frame.shape
+    for obj in items:
+        box = obj.get("bounding_box")
+        label = obj.get("category", "unknown")
+        if box and len(box) == 4:
+            x_min, y_min = int(box[0] * width), int(box[1] * height)
+            x_max, y_max = int(box[2] * width), int(box[3] * height)
+            cv2.rectangle(frame, (x_min, y_min), (x_max, y_max), (0, 255, 0), 2)
+            cv2.putText(frame, label, (x_min, y_min - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0,255,0), 2)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def run_continuous(source, classify_url, uploaders, gate=None):
+    """
+    Classifies frames continuously: `source` captures the stream in the background, `uploaders`
+    threads keep that many requests in flight over one keep-alive session, and this thread shows
+    the feed with the newest result drawn on it. With a scene `gate`, only frames showing a changed
+    scene are sent. Prints latency and throughput figures when stopped.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=uploaders)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    claims = FrameClaims(source, gate)
+    results = {"seq": 0, "items": [], "round_trip": None}
+    stats = {"lock": threading.Lock(), "round_trips": [], "completed": 0, "failed": 0}
+    stop = threading.Event()
+
+    threads = [threading.Thread(target=upload_loop, args=(session, classify_url, claims, results, stats, stop), daemon=True) for _ in range(uploaders)]
+    started = time.monotonic()
+    first_seq = claims.seq = source.latest()[0]
+    for thread in threads:
+        thread.start()
+
+    shown = 0
+    while True:
+        newest = source.wait_newer(shown, timeout=0.1)
+        if newest is not None:
+            shown, frame, _ = newest
+            frame = frame.copy()
+            with stats["lock"]:
+                items, round_trip = results["items"], results["round_trip"]
+            draw_items(frame, items)
+            if round_trip is not None:
+                cv2.putText(frame, f"{round_trip * 1000:.0f} ms", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 255), 2)
+            cv2.imshow('Live Feed', frame)
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+    stop.set()
+    elapsed = time.monotonic() - started
+    for thread in threads:
+        thread.join(timeout=30)
+    session.close()
+
+    round_trips = stats["round_trips"]
+    print("\n--- Continuous Mode Summary ---")
+    print(f"Duration: {elapsed:.1f}s")
+    captured = source.latest()[0] - first_seq
+    capture = source.stats()
+    skipped = gate.skipped if gate is not None else 0
+    print(f"Frames captured: {captured}, sent: {claims.sent}, dropped: {captured - claims.sent - skipped}")
+    print(f"Camera: {capture['fps']:.1f} FPS, {capture['reconnects']} reconnects")
+    if gate is not None:
+        print(f"Scene gate: {gate.sent} frames sent, {gate.skipped} unchanged frames skipped")
+    print(f"Results: {stats['completed']} ok, {stats['failed']} failed, {stats['completed'] / elapsed:.2f} FPS classified")
+    if round_trips:
+        print(
+            f"Round trip: p50 {percentile(round_trips, 0.50) * 1000:.0f} ms, "
+            f"p95 {percentile(round_trips, 0.95) * 1000:.0f} ms, p99 {percentile(round_trips, 0.99) * 1000:.0f} ms"
+        )
+    print("-------------------------------")
+
 def main():
     # --- Configuration ---
     PUBLIC_API_URL = "https://auro-l4mh.onrender.com"
@@ -64,6 +178,9 @@ def main():
     parser = argparse.ArgumentParser(description="Live tester for AURo classification API using a phone as an IP camera.")
     parser.add_argument("--ip", type=str, default=DEFAULT_PHONE_IP, help=f"The IP address and port of the phone camera (default: {DEFAULT_PHONE_IP})")
     parser.add_argument("--local", action="store_true", help="Use the local API server instead of the public one.")
+    parser.add_argument("--continuous", action="store_true", help="Classify frames continuously instead of on SPACE, and report latency and throughput on exit.")
+    parser.add_argument("--uploaders", type=int, default=3, help="Requests kept in flight at once in continuous mode (default: 3)")
+    add_gate_arguments(parser, enabled=False)
     args = parser.parse_args()
 
     api_base_url = LOCAL_API_URL if args.local else PUBLIC_API_URL
@@ -74,24 +191,33 @@ def main():
     print("--- AURo Live Tester ---")
     print(f"Attempting to connect to phone at: {video_url}")
     print(f"Sending images to API at: {api_base_url}")
-    print("\nPress SPACE to capture and classify a frame.")
+    if args.continuous:
+        print(f"\nContinuous mode: classifying frames with {args.uploaders} requests in flight.")
+    else:
+        print("\nPress SPACE to capture and classify a frame.")
     print("Press 'q' to quit.")
 
-    cap = cv2.VideoCapture(video_url)
-    if not cap.isOpened():
+    # One persistent connection to the camera, read in the background; it reconnects by itself.
+    source = FrameSource(video_url)
+    if not source.start(timeout=10):
+        source.stop()
         print(f"\nFATAL: Could not connect to camera stream at {video_url}. Exiting.")
         return
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            print("Error: Could not read frame from video stream.")
-            break
-            
-        # Get frame dimensions
-        height, width, _ = frame.shape
+    if args.continuous:
+        run_continuous(source, classify_url, max(1, args.uploaders), gate_from_arguments(args))
+        source.stop()
+        cv2.destroyAllWindows()
+        print("Tester stopped.")
+        return
 
-        cv2.imshow('Live Feed', frame)
+    shown = 0
+    frame = source.latest()[1]
+    while True:
+        newest = source.wait_newer(shown, timeout=0.1)
+        if newest is not None:
+            shown, frame, _ = newest
+            cv2.imshow('Live Feed', frame)
 
         key = cv2.waitKey(1) & 0xFF
         if key == ord('q'):
@@ -144,7 +270,7 @@ def main():
             else:
                 print("--- Classification Failed ---")
 
-    cap.release()
+    source.stop()
     cv2.destroyAllWindows()
     print("Tester stopped.")
 
@@ -8,6 +8,8 @@ import google.generativeai as genai
 import argparse
 import threading
 from dotenv import load_dotenv
+from frame_source import FrameSource
+from scene_gate import add_gate_arguments, gate_from_arguments
 
 load_dotenv()
 
@@ -25,28 +27,18 @@ def setup_gemini(api_key):
   print(f"Error setting up Gemini: {str(e)}")
   sys.exit(1)
 
-def get_frame_from_ip_camera(ip_address, debug=False):
- url = f'http://{ip_address}/video'
- print(f"Connecting to camera at {url}")
- try:
-  if debug:
-   print("Debug mode: Using test image instead of camera")
-   frame = create_test_image()
-   return True, frame
-  cap = cv2.VideoCapture(url)
-  if not cap.isOpened():
-   print(f"Failed to open video stream at {url}")
-   print("Check that your camera is on and accessible at this address")
-   return False, None
-  ret, frame = cap.read()
-  cap.release()
-  if not ret or frame is None:
-   print("Camera connected but failed to read frame")
-   return False, None
-  return ret, frame
- except Exception as e:
-  print(f"Error accessing camera: {str(e)}")
-  return False, None
+def get_frame_from_ip_camera(source, last_seq, debug=False):
+ """
+ Returns (seq, frame) for the first frame newer than last_seq, or (last_seq, None) if the camera
+ has nothing new within two seconds. The frame comes from the background FrameSource, so no
+ connection is opened here.
+ """
+ if debug:
+  return last_seq + 1, create_test_image()
+ newest = source.wait_newer(last_seq, timeout=2)
+ if newest is None:
+  return last_seq, None
+ return newest[0], newest[1]
 
 def create_test_image():
  img = np.zeros((480, 640, 3), np.uint8)
@@ -85,19 +77,30 @@ def main():
  parser.add_argument('--debug', action='store_true', help='Run in debug mode with test images')
  parser.add_argument('--ip', type=str, default="192.168.29.56:8080", help='IP camera address')
  parser.add_argument('--key', type=str, help='Gemini API key')
- parser.add_argument('--rate-limit', type=int, default=6, help='Time in seconds between API requests (default: 6)')
+ parser.add_argument('--rate-limit', type=int, default=6, help='Minimum time in seconds between API requests (default: 6)')
+ add_gate_arguments(parser)
  args = parser.parse_args()
  GEMINI_API_KEY = args.key or os.getenv("GEMINI_API_KEY")
  ip_camera_address = args.ip
  debug_mode = args.debug
  request_interval = args.rate_limit
  print(f"API request interval set to {request_interval} seconds")
+ # Only classify once the view has changed and settled again, instead of every interval.
+ gate = gate_from_arguments(args)
+ if gate is not None:
+  print("Classifying only when the scene changes (--no-scene-gate to disable)")
  if debug_mode:
   global np
   import numpy as np
   print("Running in DEBUG mode with test images")
  model = setup_gemini(GEMINI_API_KEY)
  print("Starting object classification...")
+ source = None
+ if not debug_mode:
+  source = FrameSource(f'http://{ip_camera_address}/video')
+  print(f"Connecting to camera at {source.url}")
+  if not source.start(timeout=10):
+   print("Camera not reachable yet; it will keep reconnecting in the background")
  def classify_in_background(model, image):
   nonlocal is_processing, last_classification
   try:
@@ -114,13 +117,16 @@ def main():
   last_classification = None
   is_processing = False
   processing_frames = 0
+  frame_seq = 0
+  scene_pending = False
+  requests_sent = 0
   while True:
-   ret, frame = get_frame_from_ip_camera(ip_camera_address, debug_mode)
-   if not ret:
-    print("Failed to capture frame from IP camera")
-    print("Retrying in 2 seconds...")
-    time.sleep(2)
+   frame_seq, frame = get_frame_from_ip_camera(source, frame_seq, debug_mode)
+   if frame is None:
+    print("No new frame from IP camera; still waiting...")
     continue
+   if gate is not None and gate.update(frame):
+    scene_pending = True
    display_frame = frame.copy()
    font = cv2.FONT_HERSHEY_SIMPLEX
    if is_processing:
@@ -129,7 +135,9 @@ def main():
     cv2.putText(display_frame, f"Processing{dots}", (10, 30), font, 1, (0, 0, 255), 2)
    elif last_classification:
     cv2.putText(display_frame, f"Object: {last_classification}", (10, 30), font, 1, (0, 255, 0), 2)
-   if not is_processing:
+   if not is_processing and gate is not None and not scene_pending:
+    cv2.putText(display_frame, "Waiting for a scene change", (10, 70), font, 0.7, (0, 200, 255), 2)
+   elif not is_processing:
     time_since_last = time.time() - last_request_time
     time_to_next = max(0, request_interval - time_since_last)
     cv2.putText(display_frame, f"Next scan in: {time_to_next:.1f}s", (10, 70), font, 0.7, (0, 200, 255), 2)
@@ -146,8 +154,10 @@ def main():
    display_frame[-status_bar_height:, :] = status_bar
    cv2.imshow('IP Camera Feed', display_frame)
    current_time = time.time()
-   if not is_processing and current_time - last_request_time >= request_interval:
+   if not is_processing and current_time - last_request_time >= request_interval and (gate is None or scene_pending):
     is_processing = True
+    scene_pending = False
+    requests_sent += 1
     last_request_time = current_time
     process_frame = frame.copy()
     thread = threading.Thread(target=classify_in_background, args=(model, process_frame))
@@ -159,16 +169,28 @@ def main():
     break
    elif key == ord('c') and not is_processing:
     print("Manual classification triggered")
+    if gate is not None:
+     gate.accept(frame)
+     scene_pending = False
     is_processing = True
+    requests_sent += 1
     last_request_time = time.time()
     process_frame = frame.copy()
     thread = threading.Thread(target=classify_in_background, args=(model, process_frame))
     thread.daemon = True
     thread.start()
-   time.sleep(0.1)
+   if debug_mode:
+    time.sleep(0.1)
  except KeyboardInterrupt:
   print("Stopping...")
  finally:
+  if gate is not None:
+   stats = gate.stats()
+   print(f"Scene gate: {stats['sent']} scene changes, {stats['skipped']} frames skipped ({stats['skipped_share']:.0%}), {requests_sent} classification requests")
+  if source is not None:
+   stats = source.stats()
+   print(f"Camera: {stats['frames']} frames, {stats['fps']:.1f} FPS, {stats['reconnects']} reconnects")
+   source.stop()
   cv2.destroyAllWindows()
 
 if __name__ == "__main__":
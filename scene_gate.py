@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+
+
+class SceneChangeGate:
+    """
+    Decides which camera frames are worth classifying, so that an unchanged scene isn't sent to
+    the API over and over.
+
+    Every frame is shrunk to a small grayscale image and compared with the previous frame (is
+    anything moving?) and with the last frame that was let through (is this a different scene?).
+    A pixel counts as changed when it differs by more than `pixel_threshold` (0-255). A frame is let
+    through once more than `change_threshold` of the pixels differ from the last classified scene
+    and the view has then been still (under `motion_threshold` changed pixels between frames)
+    for `settle_frames` frames in a row, i.e. after something was put down and the arm moved away.
+    The very first settled frame is always let through.
+    """
+    def __init__(self, change_threshold=0.02, motion_threshold=0.005, settle_frames=5, pixel_threshold=25, size=(64, 48)):
+        self.change_threshold = change_threshold
+        self.motion_threshold = motion_threshold
+        self.settle_frames = settle_frames
+        self.pixel_threshold = pixel_threshold
+        self.size = size
+        self.reference = None
+        self.previous = None
+        self.still_frames = 0
+        self.sent = 0
+        self.skipped = 0
+
+    def _prepare(self, frame):
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        # A light blur keeps sensor noise and JPEG artifacts from counting as change.
+        return cv2.GaussianBlur(small, (3, 3), 0).astype(np.int16)
+
+    def _changed_fraction(self, a, b):
+        return float(np.mean(np.abs(a - b) > self.pixel_threshold))
+
+    def update(self, frame):
+        """
+        Feeds the next frame (BGR or grayscale) and returns True if it should be classified.
+        """
+        small = self._prepare(frame)
+        moving = self.previous is not None and self._changed_fraction(small, self.previous) > self.motion_threshold
+        self.previous = small
+        self.still_frames = 0 if moving else self.still_frames + 1
+
+        changed = self.reference is None or self._changed_fraction(small, self.reference) > self.change_threshold
+        if changed and self.still_frames >= self.settle_frames:
+            self.reference = small
+            self.sent += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def accept(self, frame):
+        """
+        Makes `frame` the last classified scene, e.g. after a classification triggered by hand.
+        """
+        self.reference = self._prepare(frame)
+
+    def stats(self):
+        total = self.sent + self.skipped
+        return {"sent": self.sent, "skipped": self.skipped, "skipped_share": self.skipped / total if total else 0.0}
+
+
+def add_gate_arguments(parser, enabled=True):
+    """
+    Command line options shared by the tools that use a SceneChangeGate. With `enabled` the gate
+    is on unless `--no-scene-gate` is given, otherwise it is off unless `--scene-gate` is given.
+    """
+    if enabled:
+        parser.add_argument("--no-scene-gate", dest="scene_gate", action="store_false", help="Classify even if nothing in view has changed.")
+    else:
+        parser.add_argument("--scene-gate", dest="scene_gate", action="store_true", help="Only classify frames where the scene has changed and settled.")
+    parser.add_argument("--change-threshold", type=float, default=0.02, help="Share of pixels that must differ from the last classified scene (default: 0.02)")
+    parser.add_argument("--motion-threshold", type=float, default=0.005, help="Share of pixels changing between frames still counted as a still view (default: 0.005)")
+    parser.add_argument("--settle-frames", type=int, default=5, help="Still frames needed after a change before classifying (default: 5)")
+    parser.add_argument("--pixel-threshold", type=int, default=25, help="Gray-level difference for a pixel to count as changed (default: 25)")
+
+
+def gate_from_arguments(args):
+    if not args.scene_gate:
+        return None
+    return SceneChangeGate(args.change_threshold, args.motion_threshold, args.settle_frames, args.pixel_threshold)
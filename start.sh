@@ -12,4 +12,8 @@ pip3 install -r requirements.txt
 
 echo "--- Starting Gunicorn server with Python 3 ---"
 # Run gunicorn as a module of python3 to ensure we're using the correct one.
-python3 -m gunicorn -w 4 -k uvicorn.workers.UvicornWorker api.main:app -b 0.0.0.0:$PORT 
\ No newline at end of file
+# --preload imports the app (and, with PRELOAD_BACKENDS, the Clarifai and Gemini SDKs) once in the
+# master process; the workers forked from it share those modules instead of each importing them.
+# Connections are still opened per worker, at startup.
+export PRELOAD_BACKENDS=${PRELOAD_BACKENDS:-true}
+python3 -m gunicorn -w 4 -k uvicorn.workers.UvicornWorker --preload api.main:app -b 0.0.0.0:$PORT 
\ No newline at end of file